@@ -0,0 +1 @@
+"""Bộ đo hiệu năng: sinh dữ liệu giả lập (benchmarks.synthetic) và đo thời gian / bộ nhớ các bước xử lý (python -m benchmarks)."""
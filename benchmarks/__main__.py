@@ -0,0 +1,235 @@
+"""Đo thời gian, số dòng / giây, bộ nhớ đỉnh và cỡ đầu ra các bước xử lý trên dữ liệu giả lập, in kết quả dạng JSON.
+
+    python -m benchmarks                          # 1k / 10k / 100k dòng, in JSON ra màn hình
+    python -m benchmarks --rows 1000 10000 -o truoc.json
+    python -m benchmarks --compare truoc.json sau.json
+    python -m benchmarks --rows 100000 --only tab1      # so xlsx / csv / parquet của Tab 1
+
+Thời gian lấy nhỏ nhất qua --repeat lần chạy. Bộ nhớ đo ở 2 lần chạy riêng trước các lần tính giờ:
+- peak_mb: RSS đỉnh trong lúc chạy trừ RSS lúc bắt đầu (Metrics.stage, lấy mẫu ~10ms), tính cả bộ đệm Arrow
+  của cột chuỗi pandas 3 và bộ nhớ của xlsxwriter / thư viện C. Trước khi đo, heap đã giải phóng được trả lại hệ điều hành
+  (malloc_trim, chỉ có trên glibc); nơi khác phần nhớ tái dùng từ bước trước không được tính nên số đo thấp hơn thực tế;
+- traced_peak_mb: đỉnh các vùng nhớ Python cấp qua tracemalloc (không thấy bộ đệm Arrow / numpy cấp ngoài Python),
+  giúp tìm chỗ cấp phát nhưng thường thấp hơn thực tế.
+"""
+import argparse
+import ctypes
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+
+import voucher_core as vc
+from benchmarks import synthetic
+
+
+def build_cases(rows, days, seed):
+    """{tên bước: hàm chuẩn bị}; hàm chuẩn bị sinh dữ liệu cho cỡ `rows` rồi trả về hàm cần đo (không tham số).
+
+    Dữ liệu chỉ được sinh khi bước đó thực sự chạy (tiện cho --only với cỡ lớn).
+    """
+    month_file = {}
+
+    def receipts():
+        if not month_file:
+            month_file["name"], month_file["bytes"], month_file["rows"] = synthetic.receipts_workbook(rows, days, seed=seed)
+        return month_file["name"], month_file["bytes"], month_file["rows"]
+
+    def tab1(output_format="xlsx"):
+        file_name, workbook, _ = receipts()
+        return lambda: vc.process_single_file(
+            synthetic.NamedBytesIO(workbook, file_name), "A", vc.build_prefix(file_name), output_format=output_format,
+        )
+
+    def tab2(fuzzy_threshold=None):
+        file_name, workbook, month_rows = receipts()
+        zip_bytes = synthetic.voucher_zip(file_name, workbook)
+        base = synthetic.base_ledger(month_rows, seed=seed, accent_free=0.3 if fuzzy_threshold else 0.0)
+
+        def run_tab2():
+            get_base_keys = vc.base_keys_lookup(vc.load_base_keys(BytesIO(base)))
+            return vc.remove_duplicates_from_zip(BytesIO(zip_bytes), get_base_keys, "DA", fuzzy_threshold=fuzzy_threshold)
+        return run_tab2
+
+    def tab3():
+        monthly = synthetic.monthly_zip(rows, days, seed=seed)
+        return lambda: vc.consolidate_zip(BytesIO(monthly))
+
+    def tab3_quarter():
+        # Cùng tổng số dòng nhưng chia cho 3 ZIP tháng của 1 quý
+        zips = [
+            (f"T{month:02d}_2024.zip", synthetic.monthly_zip(rows // 3, days, seed=seed + month, month=month))
+            for month in (7, 8, 9)
+        ]
+        return lambda: vc.consolidate_zips([(name, BytesIO(data)) for name, data in zips], period="quarter")
+
+    def tab4():
+        compare_files = synthetic.comparison_workbooks(rows, days=days, seed=seed)
+
+        def run_tab4():
+            records = vc.collect_amount_records([(name, BytesIO(data)) for name, data in compare_files])
+            so_key, wide, details = vc.compare_amounts(records, [name for name, _ in compare_files])
+            return vc.comparison_workbook(wide, details)
+        return run_tab4
+
+    def tab5():
+        misa_text, excel_text = synthetic.debt_pastes(rows, seed=seed)
+        return lambda: vc.reconcile_misa_excel(misa_text, excel_text)
+
+    return {
+        "tab1_process_single_file": tab1,
+        "tab1_process_single_file_csv": lambda: tab1("csv"),
+        "tab1_process_single_file_parquet": lambda: tab1("parquet"),
+        "tab2_remove_duplicates": tab2,
+        "tab2_remove_duplicates_fuzzy": lambda: tab2(fuzzy_threshold=0.92),
+        "tab3_consolidate": tab3,
+        "tab3_consolidate_quarter": tab3_quarter,
+        "tab4_compare": tab4,
+        "tab5_reconcile": tab5,
+    }
+
+
+def output_size(value):
+    """Số byte đầu ra của 1 bước: bytes / BytesIO, dict các bytes, hoặc tuple mà phần tử đầu là đầu ra (VD: (zip, logs))."""
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, BytesIO):
+        return value.getbuffer().nbytes
+    if isinstance(value, dict) and value and all(isinstance(v, bytes) for v in value.values()):
+        return sum(len(v) for v in value.values())
+    return None
+
+try:
+    libc = ctypes.CDLL("libc.so.6")
+    libc.malloc_trim
+except (OSError, AttributeError):  # không phải glibc (macOS, Windows, musl)
+    libc = None
+
+def release_memory():
+    """Trả lại hệ điều hành bộ nhớ đã giải phóng (sinh dữ liệu, bước trước) để RSS đo được phần bước sau thực sự cần thêm."""
+    gc.collect()
+    if vc.pa is not None:
+        vc.pa.default_memory_pool().release_unused()
+    if libc is not None:
+        libc.malloc_trim(0)
+
+def measure(func, repeat, memory):
+    result = {}
+    if memory:
+        # Đo bộ nhớ trước các lần tính giờ: RSS còn giữ lại từ lần chạy trước sẽ che mất phần tăng thêm
+        release_memory()
+        metrics = vc.Metrics()
+        with metrics.stage("benchmark"):
+            func()
+        result["peak_mb"] = metrics.records[0]["stage_mem_mb"]
+        release_memory()
+        tracemalloc.start()
+        try:
+            func()
+            result["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        finally:
+            tracemalloc.stop()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        output = func()
+        timings.append(time.perf_counter() - start)
+    result = {"seconds": round(min(timings), 4), "seconds_all": [round(t, 4) for t in timings], **result}
+    size = output_size(output)
+    if size is not None:
+        result["output_kb"] = round(size / 1024, 1)
+    return result
+
+
+def run(sizes, days=5, repeat=3, memory=True, only=None, seed=0, log=sys.stderr):
+    results = []
+    for rows in sizes:
+        print(f"# {rows} dòng", file=log)
+        for name, setup in build_cases(rows, days, seed).items():
+            if only and not any(key in name for key in only):
+                continue
+            start = time.perf_counter()
+            func = setup()
+            print(f"  (sinh dữ liệu {name}: {time.perf_counter() - start:.1f}s)", file=log)
+            result = {"case": name, "rows": rows, **measure(func, repeat, memory)}
+            result["rows_per_second"] = round(rows / result["seconds"]) if result["seconds"] else None
+            print(
+                f"  {name}: {result['seconds']:.3f}s ({result['rows_per_second']} dòng/s)"
+                + (f", RSS +{result['peak_mb']} MB (tracemalloc {result['traced_peak_mb']} MB)" if memory else "")
+                + (f", đầu ra {result['output_kb']} KB" if "output_kb" in result else ""),
+                file=log,
+            )
+            results.append(result)
+    return {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "excel_engine": vc.EXCEL_ENGINE or "openpyxl",
+            "days": days, "repeat": repeat, "seed": seed, "memory": "rss",
+        },
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Bảng so sánh 2 lần đo theo (bước, số dòng): tỉ lệ < 1 là nhanh hơn / ít bộ nhớ hơn."""
+    key = ["case", "rows"]
+    merged = pd.merge(pd.DataFrame(old["results"]), pd.DataFrame(new["results"]), on=key, suffixes=("_truoc", "_sau"))
+    table = merged[key + ["seconds_truoc", "seconds_sau"]].copy()
+    table["ti_le_thoi_gian"] = (merged["seconds_sau"] / merged["seconds_truoc"]).round(2)
+    if old["meta"].get("memory") != new["meta"].get("memory"):
+        # File đo cũ (không có meta "memory"): peak_mb là đỉnh tracemalloc, không so được với RSS
+        print("# peak_mb của 2 file đo theo cách khác nhau (tracemalloc / RSS), bỏ qua so sánh bộ nhớ", file=sys.stderr)
+        merged = merged.drop(columns=["peak_mb_truoc", "peak_mb_sau"], errors="ignore")
+    for column in ("peak_mb", "traced_peak_mb"):
+        if f"{column}_truoc" in merged and f"{column}_sau" in merged:
+            table[f"{column}_truoc"] = merged[f"{column}_truoc"]
+            table[f"{column}_sau"] = merged[f"{column}_sau"]
+    if "peak_mb_truoc" in merged and "peak_mb_sau" in merged:
+        table["ti_le_bo_nho"] = (merged["peak_mb_sau"] / merged["peak_mb_truoc"]).round(2)
+    if "output_kb_truoc" in merged and "output_kb_sau" in merged:
+        table["output_kb_truoc"] = merged["output_kb_truoc"]
+        table["output_kb_sau"] = merged["output_kb_sau"]
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Đo hiệu năng các bước xử lý trên dữ liệu giả lập.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="Các cỡ dữ liệu (số dòng)")
+    parser.add_argument("--days", type=int, default=5, help="Số sheet ngày trong file tháng")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần chạy để lấy thời gian nhỏ nhất")
+    parser.add_argument("--no-memory", action="store_true", help="Bỏ 2 lần chạy đo bộ nhớ đỉnh (RSS, tracemalloc)")
+    parser.add_argument("--only", nargs="+", help="Chỉ chạy các bước có tên chứa chuỗi này (VD: tab1 tab5)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Ghi JSON ra file thay vì màn hình")
+    parser.add_argument("--compare", nargs=2, metavar=("TRUOC", "SAU"), help="So sánh 2 file JSON kết quả")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding="utf-8") as f_old, open(args.compare[1], encoding="utf-8") as f_new:
+            print(compare(json.load(f_old), json.load(f_new)).to_string(index=False))
+        return 0
+
+    report = run(args.rows, args.days, args.repeat, not args.no_memory, args.only, args.seed)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""Sinh dữ liệu giả lập giống file thu tiền bệnh viện, cùng các đầu vào tương ứng cho Tab 1 → Tab 5.
+
+Mọi hàm nhận seed nên cùng tham số luôn cho ra cùng dữ liệu (so sánh được giữa các lần đo).
+"""
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import voucher_core as vc
+
+ho = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Võ", "Đặng", "Bùi", "Đỗ", "Hồ", "Ngô", "Dương", "Lý"]
+dem = ["Văn", "Thị", "Hữu", "Đức", "Thanh", "Minh", "Ngọc", "Quốc", "Thu", "Xuân", "Hoài", ""]
+ten = ["An", "Bình", "Cường", "Dũng", "Giang", "Hà", "Hải", "Hạnh", "Hùng", "Hương", "Khánh", "Lan", "Linh",
+       "Long", "Mai", "Nam", "Nga", "Phúc", "Phương", "Quân", "Sơn", "Tâm", "Thảo", "Trang", "Tuấn", "Yến"]
+
+# (KHOA/BỘ PHẬN, NỘI DUNG THU, tỉ lệ) — có cả dòng bị bỏ qua (Thẻ) và dòng chỉ nhận ra nhóm qua nội dung thu
+departments = [
+    ("Khoa Khám bệnh", "Khám bệnh", 0.40),
+    ("Khoa Nội", "Xét nghiệm", 0.15),
+    ("Nhà thuốc", "Bán thuốc", 0.20),
+    ("Phòng tiêm VACXIN", "Tiêm chủng", 0.12),
+    ("Khoa Nhi", "Vaccine", 0.05),
+    ("Quầy Thẻ", "Nạp thẻ", 0.08),
+]
+
+
+def patient_names(n, rng):
+    """Họ tên tiếng Việt có dấu, viết thường / hoa lẫn lộn như nhập tay."""
+    names = (
+        pd.Series(rng.choice(ho, n)) + " " + pd.Series(rng.choice(dem, n)) + " " + pd.Series(rng.choice(ten, n))
+    ).str.replace("  ", " ", regex=False)
+    style = rng.random(n)
+    names = names.where(style > 0.2, names.str.upper())
+    return names.where(style > 0.1, names.str.lower())
+
+
+def receipts_frame(rows, day, month=7, year=2024, rng=None):
+    """1 sheet ngày: KHOA/BỘ PHẬN, TRẢ THẺ (dương = thu, âm = chi, có ô 0 / "-"), NGÀY QUỸ, HỌ VÀ TÊN, NỘI DUNG THU."""
+    rng = rng if rng is not None else np.random.default_rng(0)
+    dept = rng.choice(len(departments), rows, p=[d[2] for d in departments])
+    amount = rng.integers(1, 400, rows) * 5000
+    sign = np.where(rng.random(rows) < 0.08, -1, 1)
+    tra_the = pd.Series(amount * sign, dtype=object)
+    noise = rng.random(rows)
+    tra_the[noise < 0.03] = 0
+    tra_the[(noise >= 0.03) & (noise < 0.05)] = "-"
+    ngay = pd.Series(pd.Timestamp(year, month, day), index=range(rows), dtype=object)
+    ngay[rng.random(rows) < 0.1] = f"{day:02d}/{month:02d}/{year}"
+    return pd.DataFrame({
+        "STT": np.arange(1, rows + 1),
+        "KHOA/BỘ PHẬN": [departments[i][0] for i in dept],
+        "TRẢ THẺ": tra_the,
+        "NGÀY QUỸ": ngay,
+        "HỌ VÀ TÊN": patient_names(rows, rng),
+        "NỘI DUNG THU": [departments[i][1] for i in dept],
+    })
+
+
+def receipts_workbook(rows, days=5, month=7, year=2024, seed=0):
+    """File Excel tháng cho Tab 1: `days` sheet ngày tên là số, tổng cộng `rows` dòng, cộng 1 sheet tổng bị bỏ qua.
+
+    Trả về (tên file, bytes, bảng dữ liệu gốc đã gộp).
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.full(days, rows // days)
+    sizes[: rows % days] += 1
+    frames = {str(day): receipts_frame(int(n), day, month, year, rng) for day, n in zip(range(1, days + 1), sizes)}
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        for sheet, df in frames.items():
+            df.to_excel(writer, sheet_name=sheet, index=False)
+        pd.DataFrame({"Tổng": [len(frames)]}).to_excel(writer, sheet_name="Tong", index=False)
+    return f"T{month:02d}_{year}.xlsx", output.getvalue(), pd.concat(frames.values(), ignore_index=True)
+
+
+class NamedBytesIO(BytesIO):
+    """BytesIO có thuộc tính name giống file tải lên của Streamlit."""
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def voucher_zip(file_name, file_bytes, chu_hau_to="A", output_format="xlsx"):
+    """ZIP đầu ra Tab 1 của 1 file tháng (đầu vào Tab 2 / Tab 3)."""
+    zip_buffer, _ = vc.process_single_file(
+        NamedBytesIO(file_bytes, file_name), chu_hau_to, vc.build_prefix(file_name), output_format=output_format,
+    )
+    return zip_buffer.getvalue()
+
+
+def base_ledger(receipts, overlap=0.5, seed=0, accent_free=0.0):
+    """File Gốc cho Tab 2: lấy ngẫu nhiên `overlap` phần các dòng hợp lệ (cùng khoá Tên + Ngày + Số tiền) và thêm dòng lạ.
+
+    accent_free: tỉ lệ tên lấy sang bị gõ không dấu (chỉ khớp được ở chế độ gần trùng).
+    """
+    rng = np.random.default_rng(seed)
+    amount = pd.to_numeric(receipts["TRẢ THẺ"], errors="coerce")
+    valid = receipts[amount.notna() & (amount != 0)]
+    picked = valid[rng.random(len(valid)) < overlap]
+    names = vc.format_names(picked["HỌ VÀ TÊN"])
+    if accent_free:
+        names = names.where(rng.random(len(names)) >= accent_free, names.map(vc.fold_accents))
+    extra = max(1, len(picked) // 5)
+    df = pd.DataFrame({
+        "Ngày hạch toán (*)": pd.concat([
+            vc.format_date_column(picked["NGÀY QUỸ"]),
+            pd.Series(["28/07/2024"] * extra),
+        ], ignore_index=True),
+        "Tên đối tượng": pd.concat([names, patient_names(extra, rng)], ignore_index=True),
+        "Số tiền": np.concatenate([pd.to_numeric(picked["TRẢ THẺ"]).abs().to_numpy(), rng.integers(1, 400, extra) * 5000]),
+    })
+    output = BytesIO()
+    df.to_excel(output, index=False)
+    return output.getvalue()
+
+
+def voucher_rows(rows, days=5, month=7, year=2024, seed=0):
+    """Bảng chứng từ dạng đầu ra (Ngày chứng từ, Số chứng từ, Tên đối tượng, Số tiền) kèm nhóm, PT/PC và ngày."""
+    rng = np.random.default_rng(seed)
+    day = rng.integers(1, days + 1, rows)
+    category = rng.choice(["KCB", "THUOC", "VACCINE"], rows, p=[0.6, 0.25, 0.15])
+    mode = np.where(rng.random(rows) < 0.9, "PT", "PC")
+    ngay = pd.Series([f"{d:02d}/{month:02d}/{year}" for d in range(1, days + 1)])[day - 1].reset_index(drop=True)
+    return pd.DataFrame({
+        "Ngày chứng từ (*)": ngay,
+        "Số chứng từ (*)": "NVK" + pd.Series(category) + ngay.str.replace("/", "", regex=False) + "A",
+        "Tên đối tượng": vc.format_names(patient_names(rows, rng)),
+        "Số tiền": rng.integers(1, 400, rows) * 5000,
+        "CATEGORY": category,
+        "MODE": mode,
+        "DAY": day,
+    })
+
+
+def monthly_zip(rows, days=5, seed=0, month=7, year=2024, output_format="xlsx"):
+    """ZIP đầu vào Tab 3: đúng ZIP đầu ra Tab 1 của 1 file tháng `rows` dòng (<nhóm>/PT.xlsx, PC.xlsx, mỗi ngày 1 sheet)."""
+    file_name, workbook, _ = receipts_workbook(rows, days, month, year, seed=seed)
+    return voucher_zip(file_name, workbook, output_format=output_format)
+
+
+def comparison_workbooks(rows, files=3, change_rate=0.01, days=5, seed=0):
+    """Các file cho Tab 4: cùng 1 bảng chứng từ, mỗi file sửa số tiền của khoảng `change_rate` phần số dòng.
+
+    Trả về danh sách (tên file, bytes).
+    """
+    rng = np.random.default_rng(seed)
+    vouchers = voucher_rows(rows, days, seed=seed)
+    result = []
+    for i in range(files):
+        df = vouchers.copy()
+        if i:
+            changed = rng.random(rows) < change_rate
+            df.loc[changed, "Số tiền"] += 1000
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+            for day, sheet in df.groupby("DAY"):
+                sheet[["Ngày chứng từ (*)", "Số chứng từ (*)", "Tên đối tượng", "Số tiền"]].to_excel(writer, sheet_name=str(day), index=False)
+        result.append((f"SoSanh_{i + 1}.xlsx", output.getvalue()))
+    return result
+
+
+def vn_number(values, thousands="."):
+    return pd.Series(values).map(lambda v: f"{v:,}".replace(",", thousands))
+
+
+def debt_pastes(rows, seed=0):
+    """Cặp văn bản dán cho Tab 5: (bảng công nợ MISA, bảng thu tiền Excel) với khoảng `rows` dòng phát sinh.
+
+    Mỗi khách 1 dòng mã y tế rồi vài dòng ngày (phát sinh ở cột 11); bảng Excel có 1 dòng/khách, vài khách bị lệch tiền.
+    """
+    rng = np.random.default_rng(seed)
+    customers = max(1, rows // 4)
+    per_customer = rng.integers(1, 8, customers)
+    ma = pd.Series([f"BN{i:07d}" for i in range(customers)])
+    names = patient_names(customers, rng)
+    amounts = rng.integers(1, 400, per_customer.sum()) * 5000
+    owner = np.repeat(np.arange(customers), per_customer)
+    days = rng.integers(1, 29, len(owner))
+
+    ngay_lines = (
+        pd.Series([f"{d:02d}/07/2024" for d in days]) + "\t" + "\t".join(["NVK", "Thu tiền", "131", "1121"] + [""] * 5)
+        + "\t" + vn_number(amounts) + "\t0\t" + vn_number(amounts)
+    )
+    header_lines = ma
+    order = np.argsort(np.concatenate([np.arange(customers) * 2, owner * 2 + 1]), kind="stable")
+    misa_lines = pd.concat([header_lines, ngay_lines], ignore_index=True)[order]
+    misa_text = "Mã khách hàng\tTên khách hàng\n" + "\n".join(misa_lines)
+
+    totals = pd.Series(amounts).groupby(owner).sum().reindex(range(customers), fill_value=0).to_numpy()
+    totals = totals + np.where(rng.random(customers) < 0.05, 10000, 0)
+    excel_lines = (
+        pd.Series(np.arange(1, customers + 1)).astype(str) + "\t01/07/2024\tPT\tKCB\t" + names + "\t"
+        + ma.str[:2] + "." + ma.str[2:] + "\t" + vn_number(totals, thousands=",") + "\t" + vn_number(totals, thousands=",") + "\t0"
+    )
+    excel_text = "STT\tNgày\tLoại\tNhóm\tHọ tên\tMã Y tế\tSố tiền\tTiền mặt\tTrả thẻ\n" + "\n".join(excel_lines)
+    return misa_text, excel_text
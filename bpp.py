@@ -1,5 +1,10 @@
 import streamlit as st
+import pandas as pd
 import re
+import hashlib
+from io import BytesIO, StringIO
+
+MATCH_TOLERANCE = 1000
 
 def parse_misa_text(misa_text):
     # Tìm tên khách hàng
@@ -33,25 +38,124 @@ def parse_excel_text(excel_text):
                 continue
     return total_payment
 
+# ====== CHẾ ĐỘ HÀNG LOẠT =======
+def normalize_customer(names):
+    return names.astype(str).str.strip().str.replace(r"\s+", " ", regex=True).str.upper()
+
+def parse_misa_ledger(misa_text):
+    """Tách sổ MISA nhiều khách hàng theo dòng "Tên khách hàng:".
+
+    Mỗi khách hàng lấy số dương cuối cùng trong đoạn của mình, giống parse_misa_text.
+    """
+    lines = pd.Series(misa_text.splitlines(), dtype=object).str.strip()
+    customer = lines.str.extract(r"Tên khách hàng:\s*(.+)", expand=False).str.strip().ffill()
+    values = pd.to_numeric(lines.str.replace('.', '', regex=False).str.replace(',', '.', regex=False), errors="coerce")
+    keep = customer.notna() & (values > 0)
+    totals = pd.DataFrame({"Khách hàng": customer[keep], "Tổng MISA": values[keep]}).groupby("Khách hàng", sort=False)["Tổng MISA"].last()
+    totals = totals.reindex(customer.dropna().unique(), fill_value=0)
+    return totals.rename_axis("Khách hàng").reset_index()
+
+def read_fee_sheet(pasted_text=None, uploaded_file=None):
+    """Đọc bảng viện phí có dòng tiêu đề, từ file Excel tải lên hoặc nội dung dán (phân tách bằng tab)."""
+    if uploaded_file is not None:
+        return pd.read_excel(uploaded_file)
+    return pd.read_csv(StringIO(pasted_text.strip()), sep="\t", dtype=str, skip_blank_lines=True)
+
+def sum_fee_sheet(fee_df, name_col, amount_cols):
+    """Cộng các cột số tiền theo khách hàng (ô không phải số bị bỏ qua, giống parse_excel_text)."""
+    amounts = fee_df[amount_cols].apply(
+        lambda col: pd.to_numeric(col.astype(str).str.strip().str.replace(',', '', regex=False).str.replace('–', '-', regex=False), errors="coerce")
+    )
+    totals = pd.DataFrame({"Khách hàng": fee_df[name_col], "Tổng Excel": amounts.sum(axis=1, min_count=1).fillna(0)})
+    totals = totals[totals["Khách hàng"].notna() & (totals["Khách hàng"].astype(str).str.strip() != "")]
+    return totals.groupby("Khách hàng", sort=False)["Tổng Excel"].sum().reset_index()
+
+def reconcile_customers(misa_totals, fee_totals, tolerance=MATCH_TOLERANCE):
+    """Ghép 2 bên theo tên khách hàng (đã chuẩn hoá) và phân loại KHỚP / DƯ / THIẾU."""
+    misa = misa_totals.assign(KEY=normalize_customer(misa_totals["Khách hàng"]))
+    fee = fee_totals.assign(KEY=normalize_customer(fee_totals["Khách hàng"]))
+    misa = misa.groupby("KEY", sort=False).agg({"Khách hàng": "first", "Tổng MISA": "sum"})
+    fee = fee.groupby("KEY", sort=False).agg({"Khách hàng": "first", "Tổng Excel": "sum"})
+    df = misa.join(fee, how="outer", lsuffix="", rsuffix=" (Excel)")
+    df["Khách hàng"] = df["Khách hàng"].fillna(df["Khách hàng (Excel)"])
+    df["Tổng MISA"] = df["Tổng MISA"].fillna(0)
+    df["Tổng Excel"] = df["Tổng Excel"].fillna(0)
+    df["Chênh lệch"] = df["Tổng Excel"] - df["Tổng MISA"]
+    df["Trạng thái"] = "KHỚP"
+    df.loc[(df["Chênh lệch"].abs() >= tolerance) & (df["Chênh lệch"] > 0), "Trạng thái"] = "DƯ"
+    df.loc[(df["Chênh lệch"].abs() >= tolerance) & (df["Chênh lệch"] < 0), "Trạng thái"] = "THIẾU"
+    df = df[["Khách hàng", "Tổng MISA", "Tổng Excel", "Chênh lệch", "Trạng thái"]]
+    return df.sort_values("Chênh lệch", key=lambda s: s.abs(), ascending=False).reset_index(drop=True)
+
 st.title("🔍 Kiểm tra khớp số liệu MISA vs Excel viện phí")
 
-misa_input = st.text_area("📋 Dán nội dung từ MISA", height=300)
-excel_input = st.text_area("📋 Dán nội dung từ bảng Excel viện phí", height=300)
-
-if st.button("🧠 Phân tích"):
-    if misa_input and excel_input:
-        customer, total_misa = parse_misa_text(misa_input)
-        total_excel = parse_excel_text(excel_input)
-        chenh_lech = total_excel - total_misa
-
-        st.markdown(f"### 🧑‍⚕️ Khách hàng: **{customer}**")
-        st.write(f"📌 Tổng chi phí từ MISA: `{total_misa:,.0f}` đ")
-        st.write(f"📌 Tổng thanh toán theo Excel: `{total_excel:,.0f}` đ")
-        if abs(chenh_lech) < 1000:
-            st.success("✅ Số liệu ĐÃ KHỚP!")
-        elif chenh_lech > 0:
-            st.warning(f"⚠️ DƯ **{chenh_lech:,.0f}** đ → Khách hàng thanh toán nhiều hơn!")
+che_do = st.radio("Chế độ", ["Một khách hàng", "Hàng loạt (nhiều khách hàng)"], horizontal=True)
+
+if che_do == "Một khách hàng":
+    misa_input = st.text_area("📋 Dán nội dung từ MISA", height=300)
+    excel_input = st.text_area("📋 Dán nội dung từ bảng Excel viện phí", height=300)
+
+    if st.button("🧠 Phân tích"):
+        if misa_input and excel_input:
+            customer, total_misa = parse_misa_text(misa_input)
+            total_excel = parse_excel_text(excel_input)
+            chenh_lech = total_excel - total_misa
+
+            st.markdown(f"### 🧑‍⚕️ Khách hàng: **{customer}**")
+            st.write(f"📌 Tổng chi phí từ MISA: `{total_misa:,.0f}` đ")
+            st.write(f"📌 Tổng thanh toán theo Excel: `{total_excel:,.0f}` đ")
+            if abs(chenh_lech) < MATCH_TOLERANCE:
+                st.success("✅ Số liệu ĐÃ KHỚP!")
+            elif chenh_lech > 0:
+                st.warning(f"⚠️ DƯ **{chenh_lech:,.0f}** đ → Khách hàng thanh toán nhiều hơn!")
+            else:
+                st.error(f"❌ THIẾU **{-chenh_lech:,.0f}** đ → Khách hàng thanh toán chưa đủ!")
+        else:
+            st.error("Vui lòng dán đủ dữ liệu từ MISA và Excel!")
+else:
+    col1, col2 = st.columns(2)
+    with col1:
+        misa_file = st.file_uploader("📂 Sổ chi tiết MISA (.txt/.csv)", type=["txt", "csv"])
+        misa_input = st.text_area("📋 ...hoặc dán toàn bộ sổ MISA", height=250)
+    with col2:
+        fee_file = st.file_uploader("📂 Bảng viện phí (.xlsx, có dòng tiêu đề)", type=["xlsx"])
+        fee_input = st.text_area("📋 ...hoặc dán bảng viện phí (kèm dòng tiêu đề)", height=250)
+
+    misa_text = misa_file.getvalue().decode("utf-8-sig") if misa_file else misa_input
+    fee_df = read_fee_sheet(fee_input, fee_file) if (fee_file or fee_input.strip()) else None
+
+    if fee_df is not None:
+        cols = [str(c) for c in fee_df.columns]
+        fee_df.columns = cols
+        goi_y_ten = next((i for i, c in enumerate(cols) if c.strip().lower() in ["họ và tên", "họ tên", "tên khách hàng", "tên đối tượng"]), 0)
+        name_col = st.selectbox("👤 Cột tên khách hàng", cols, index=goi_y_ten)
+        amount_cols = st.multiselect("💰 Các cột số tiền cần cộng", [c for c in cols if c != name_col])
+
+    chi_lech = st.checkbox("Chỉ hiện khách hàng lệch", value=True)
+
+    def batch_key():
+        # Kết quả chỉ còn đúng khi sổ MISA, bảng viện phí và các cột đã chọn không đổi
+        h = hashlib.sha256(misa_text.encode("utf-8"))
+        h.update(repr((list(fee_df.columns), name_col, amount_cols)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(fee_df.astype(str), index=False).to_numpy().tobytes())
+        return h.hexdigest()
+
+    if st.button("🧠 Đối chiếu hàng loạt"):
+        if misa_text and fee_df is not None and amount_cols:
+            misa_totals = parse_misa_ledger(misa_text)
+            fee_totals = sum_fee_sheet(fee_df, name_col, amount_cols)
+            result = reconcile_customers(misa_totals, fee_totals)
+            output = BytesIO()
+            result.to_excel(output, index=False)
+            # Giữ kết quả qua các lần rerun (bật / tắt lọc, bấm tải về) thay vì chỉ hiện ngay sau khi bấm nút
+            st.session_state["batch_result"] = (batch_key(), result, output.getvalue())
         else:
-            st.error(f"❌ THIẾU **{-chenh_lech:,.0f}** đ → Khách hàng thanh toán chưa đủ!")
-    else:
-        st.error("Vui lòng dán đủ dữ liệu từ MISA và Excel!")
+            st.error("Vui lòng nhập sổ MISA, bảng viện phí và chọn ít nhất 1 cột số tiền!")
+
+    saved = st.session_state.get("batch_result")
+    if saved and fee_df is not None and saved[0] == batch_key():
+        _, result, excel_bytes = saved
+        so_lech = int((result["Trạng thái"] != "KHỚP").sum())
+        st.markdown(f"### 📊 {len(result)} khách hàng — {so_lech} khách hàng lệch (ngưỡng {MATCH_TOLERANCE:,} đ)")
+        st.dataframe(result[result["Trạng thái"] != "KHỚP"] if chi_lech else result, use_container_width=True)
+        st.download_button("⬇️ Tải bảng đối chiếu (Excel)", data=excel_bytes, file_name="doi_chieu_hang_loat.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
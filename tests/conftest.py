@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Các module nằm ở thư mục gốc repo (không đóng gói): cho pytest import được voucher_core / benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
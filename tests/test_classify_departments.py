@@ -0,0 +1,37 @@
+"""classify_departments (theo cột) phải phân loại giống hệt classify_department (từng dòng)."""
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import voucher_core as vc
+
+atoms = ["vaccine", "VACXIN", "thuốc", "THUỐC", "thẻ", "Thẻ", "khám", "Nội", "thuoc", "the", " ", "ẻ", "12"]
+
+
+def random_cell(rng):
+    # Chuỗi ghép từ các từ khoá (hoa / thường, có dấu / không dấu) lẫn ô trống, NaN và số
+    r = rng.random()
+    if r < 0.05:
+        return None
+    if r < 0.1:
+        return np.nan
+    if r < 0.15:
+        return rng.choice([0, 1.5, 12, ""])
+    return "".join(rng.choice(atoms) for _ in range(rng.randint(1, 3)))
+
+
+@pytest.mark.parametrize("has_content", [True, False])
+def test_matches_row_by_row_classifier(has_content):
+    rng = random.Random(0)
+    n = 20000
+    df = pd.DataFrame({"KHOA/BỘ PHẬN": [random_cell(rng) for _ in range(n)]})
+    if has_content:
+        df["NỘI DUNG THU"] = [random_cell(rng) for _ in range(n)]
+
+    expected = df.apply(lambda row: vc.classify_department(row["KHOA/BỘ PHẬN"], row.get("NỘI DUNG THU")), axis=1)
+    result = vc.classify_departments(df)
+
+    assert result.index.equals(df.index)
+    assert list(result.astype(str)) == list(expected)
@@ -0,0 +1,30 @@
+"""format_sct_column (theo cột) phải cho số chứng từ giống hệt format_sct (từng dòng)."""
+import datetime as dt
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import voucher_core as vc
+
+# Chuỗi dd/mm/yyyy, ISO, ngày sai, ô trống / "-", Timestamp, datetime, số serial Excel, chữ
+dates = ["01/07/2024", "31/07/2024", "2024-07-05", "13/13/2024", "", "-", None, np.nan,
+         pd.Timestamp(2024, 7, 9), dt.datetime(2024, 7, 10), 45480.0, "abc"]
+dien_giai = ["Thu tiền khám", "Chi tiền bán thuốc", "chi tiền", None, np.nan, "", 5]
+
+
+@pytest.mark.parametrize("has_dien_giai", [True, False])
+@pytest.mark.parametrize("chu_hau_to", ["DA", "A"])
+def test_matches_row_by_row_format(has_dien_giai, chu_hau_to):
+    rng = random.Random(5)
+    n = 3000
+    df = pd.DataFrame({"Ngày chứng từ (*)": [rng.choice(dates) for _ in range(n)]})
+    if has_dien_giai:
+        df["Diễn giải"] = [rng.choice(dien_giai) for _ in range(n)]
+
+    expected = df.apply(lambda row: vc.format_sct(row, chu_hau_to), axis=1)
+    result = vc.format_sct_column(df, chu_hau_to)
+
+    assert result.index.equals(df.index)
+    assert list(result) == list(expected)
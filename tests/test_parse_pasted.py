@@ -0,0 +1,102 @@
+"""parse_misa / parse_excel (đọc cả bảng dán 1 lần) phải cho kết quả giống các hàm đọc từng dòng cũ."""
+import random
+import re
+
+import pandas as pd
+
+import voucher_core as vc
+
+
+def old_parse_misa(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    records = []
+    current_ma = ""
+    for line in lines:
+        if re.match(r'^[A-Z0-9]{6,}', line):
+            current_ma = line.strip()
+        elif re.match(r'^\d{2}/\d{2}/\d{4}', line):
+            parts = line.split("\t")
+            # Bản cũ là >= 10: dòng ngày đúng 10 ô bị IndexError ở parts[10] (xem test_misa_ten_field_date_line_is_skipped)
+            if len(parts) >= 11:
+                so_phat_sinh = parts[10].replace('.', '').replace(',', '.').strip()
+                try:
+                    records.append({'Mã Y Tế': current_ma, 'Phát sinh': float(so_phat_sinh)})
+                except ValueError:
+                    pass
+    return pd.DataFrame(records)
+
+
+def old_parse_excel(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    records = []
+    for line in lines:
+        parts = line.split("\t")
+        if len(parts) >= 6:
+            try:
+                ho_ten = parts[4].strip().upper()
+                ma_y_te = parts[5].strip().replace('.', '')
+                da_thu = float(parts[6].replace(',', '').strip())
+                records.append({'Mã Y Tế': ma_y_te, 'Họ tên': ho_ten, 'Đã thu': da_thu})
+            except (IndexError, ValueError):
+                continue
+    return pd.DataFrame(records)
+
+
+def misa_text(n, rng):
+    # Dòng mã y tế, dòng tiêu đề / trống, dòng ngày có tab đầu, số kiểu 1.200.000 / 1.500,5 / rỗng / chữ, ô thừa cuối dòng
+    out = []
+    for i in range(n):
+        if rng.random() < 0.1:
+            out.append(rng.choice(["BN%06d" % i, "  YT%07d\tNguyễn A" % i, "Tên khách hàng: X", "", "   "]))
+            continue
+        fields = ([rng.choice(["01/07/2024", "\t01/07/2024", "1/7/2024"])] + ["x"] * 9
+                  + [rng.choice(["1.200.000", "1.500,5", "", " 12 ", "abc", "-3.000"])]
+                  + rng.choice([[], ["", ""], ["9"], ["  "]]))
+        out.append("\t".join(fields) + rng.choice(["", " ", "\t"]))
+    return "\n".join(out)
+
+
+def excel_text(n, rng):
+    out = []
+    for _ in range(n):
+        fields = (["1", "a", "b", "c", rng.choice([" nguyễn văn a ", "b"]), rng.choice(["12.345", "YT1"]),
+                   rng.choice(["1,200,000", "", "x", " 500 "])] + rng.choice([[], ["z"], ["", ""]]))
+        if rng.random() < 0.1:
+            fields = fields[:rng.randint(1, 6)]
+        out.append(("\t" if rng.random() < 0.05 else "") + "\t".join(fields))
+    return "\r\n".join(out)
+
+
+def test_parse_misa_matches_line_parser():
+    text = misa_text(2000, random.Random(7))
+    expected = old_parse_misa(text)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(vc.parse_misa(text), expected)
+
+
+def test_parse_excel_matches_line_parser():
+    text = excel_text(2000, random.Random(7))
+    expected = old_parse_excel(text)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(vc.parse_excel(text), expected)
+
+
+def test_misa_ten_field_date_line_is_skipped():
+    # Khác bản cũ: dòng ngày chỉ có 10 ô (không có cột Phát sinh) bị bỏ qua, bản cũ lỗi IndexError cả lần dán
+    text = "\n".join([
+        "BN000001",
+        "\t".join(["01/07/2024"] + ["x"] * 9),
+        "\t".join(["02/07/2024"] + ["x"] * 9 + ["1.200.000"]),
+    ])
+    result = vc.parse_misa(text)
+    assert list(result["Mã Y Tế"]) == ["BN000001"]
+    assert list(result["Phát sinh"]) == [1200000.0]
+
+
+def test_empty_paste_returns_empty_frame():
+    # Khác bản cũ: dán rỗng vẫn trả bảng rỗng có đủ cột (bản cũ trả DataFrame không có cột nào)
+    for text in ["", "   \n\t\n"]:
+        misa = vc.parse_misa(text)
+        excel = vc.parse_excel(text)
+        assert misa.empty and list(misa.columns) == ["Mã Y Tế", "Phát sinh"]
+        assert excel.empty and list(excel.columns) == ["Mã Y Tế", "Họ tên", "Đã thu"]
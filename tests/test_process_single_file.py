@@ -0,0 +1,94 @@
+"""Tab 1: cột "Số tiền" ghi thẳng số (trước đây ghi công thức =VALUE(x) rồi mới đổi sang số)."""
+import re
+import zipfile
+from io import BytesIO
+
+import openpyxl
+import pandas as pd
+
+import voucher_core as vc
+from benchmarks.synthetic import NamedBytesIO
+
+
+def old_amount(x):
+    # Cách cũ: ghi "=VALUE(|x|)" rồi bước dọn dẹp thay bằng float(số trong ngoặc)
+    return float(re.search(r"=VALUE\(([\d.]+)\)", f"=VALUE({abs(x)})").group(1))
+
+
+def small_workbook():
+    day_1 = pd.DataFrame({
+        "KHOA/BỘ PHẬN": ["Khoa Khám bệnh", "Nhà thuốc", "Phòng tiêm VACXIN", "Quầy Thẻ", "Khoa Nội", "Khoa Nội", "Khoa Nội", "Khoa Khám bệnh"],
+        "TRẢ THẺ": [150000, 12345.5, -80000, 50000, 0, "-", 20000, 45000.5],
+        "NGÀY QUỸ": ["01/07/2024"] * 8,
+        "HỌ VÀ TÊN": ["Nguyễn Văn An", "Trần Thị Bình", "Lê Hữu Cường", "Phạm Minh Dũng", "Võ Lan", "Đỗ Mai", "-", "Võ Thị Yến"],
+        "NỘI DUNG THU": ["Khám bệnh", "Bán thuốc", "Tiêm chủng", "Nạp thẻ", "Xét nghiệm", "Xét nghiệm", "Xét nghiệm", "Khám bệnh"],
+    })
+    day_2 = pd.DataFrame({
+        "KHOA/BỘ PHẬN": ["Khoa Nhi", "Khoa Khám bệnh", "Khoa Khám bệnh"],
+        "TRẢ THẺ": [99999.25, -35000.5, 7000],
+        "NGÀY QUỸ": [pd.Timestamp(2024, 7, 2)] * 3,
+        "HỌ VÀ TÊN": ["Hồ Thu Hà", "Ngô Quốc Hải", "Bùi Xuân Hạnh"],
+        "NỘI DUNG THU": ["Vaccine", "Khám bệnh", "Khám bệnh"],
+    })
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        day_1.to_excel(writer, sheet_name="1", index=False)
+        day_2.to_excel(writer, sheet_name="2", index=False)
+        pd.DataFrame({"Tổng": [2]}).to_excel(writer, sheet_name="Tong", index=False)
+    return output.getvalue()
+
+
+def output_amounts(zip_bytes):
+    amounts = {"PT": [], "PC": []}
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as zipf:
+        for name in zipf.namelist():
+            mode = name.rsplit("/", 1)[-1].split(".")[0]
+            workbook = openpyxl.load_workbook(BytesIO(zipf.read(name)), read_only=True)
+            for sheet in workbook.worksheets:
+                rows = sheet.iter_rows(values_only=True)
+                column = next(rows).index("Số tiền")
+                amounts[mode].extend(row[column] for row in rows)
+    return amounts
+
+
+def test_so_tien_is_numeric_and_matches_old_value_formula():
+    zip_buffer, _ = vc.process_single_file(NamedBytesIO(small_workbook(), "T07_2024.xlsx"), "A", "T07_2024")
+    amounts = output_amounts(zip_buffer.getvalue())
+
+    # Dòng hợp lệ (bỏ ô 0 / "-", tên "-", khoa Thẻ); thu → PT, chi → PC
+    expected = {
+        "PT": sorted(old_amount(x) for x in [150000, 12345.5, 99999.25, 7000, 45000.5]),
+        "PC": sorted(old_amount(x) for x in [-80000, -35000.5]),
+    }
+    for mode, values in amounts.items():
+        assert all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values), values
+        assert sorted(values) == expected[mode]
+
+
+def test_so_tien_format_keeps_decimals():
+    # '#,##0' hiện 12345.5 thành 12,346: ô lẻ dùng '#,##0.##', ô nguyên giữ '#,##0' (không có dấu "." thừa ở cuối)
+    zip_buffer, _ = vc.process_single_file(NamedBytesIO(small_workbook(), "T07_2024.xlsx"), "A", "T07_2024")
+    formats = {}
+    with zipfile.ZipFile(zip_buffer) as zipf:
+        for name in zipf.namelist():
+            workbook = openpyxl.load_workbook(BytesIO(zipf.read(name)))
+            for sheet in workbook.worksheets:
+                column = [cell.value for cell in sheet[1]].index("Số tiền")
+                formats.update((row[column].value, row[column].number_format) for row in sheet.iter_rows(min_row=2))
+    assert formats == {
+        150000: "#,##0", 7000: "#,##0", 80000: "#,##0",
+        12345.5: "#,##0.##", 45000.5: "#,##0.##", 99999.25: "#,##0.##", 35000.5: "#,##0.##",
+    }
+
+
+def test_csv_writes_whole_amounts_without_decimal_point():
+    # File KCB / PT ngày 1 có cả số nguyên và số lẻ: số nguyên vẫn ghi "150000" (không phải "150000.0") để nhập MISA
+    zip_buffer, _ = vc.process_single_file(
+        NamedBytesIO(small_workbook(), "T07_2024.xlsx"), "A", "T07_2024", output_format="csv",
+    )
+    amounts = []
+    with zipfile.ZipFile(zip_buffer) as zipf:
+        for name in zipf.namelist():
+            frame = pd.read_csv(BytesIO(zipf.read(name)), dtype=str, encoding="utf-8-sig")
+            amounts.extend(frame["Số tiền"])
+    assert sorted(amounts) == sorted(["150000", "45000.5", "12345.5", "99999.25", "7000", "80000", "35000.5"])
@@ -0,0 +1,40 @@
+"""Kho chứng từ Parquet: lọc các dòng cho Tab 4 theo cặp (tên, số chứng từ)."""
+import pandas as pd
+import pytest
+
+import voucher_core as vc
+
+pytest.importorskip("pyarrow")
+
+
+def voucher_part(rows):
+    return pd.DataFrame(rows, columns=["Ngày chứng từ (*)", "Tên đối tượng", "Số tiền", "Số chứng từ (*)"])
+
+
+def test_amount_records_filters_on_name_and_voucher_pairs(tmp_path):
+    archive = vc.VoucherArchive(str(tmp_path / "kho"))
+    archive.append(vc.archive_frame({
+        ("KCB", "PT", "1"): voucher_part([
+            ["01/07/2024", "Nguyễn Văn An", 150000, "NVKKCB010724A"],
+            ["01/07/2024", "Trần_Thị Bình", 200000, "NVKKCB010724A"],
+            ["01/07/2024", "Lê Hữu Cường", 300000, "NVKKCB010724A"],
+        ]),
+        ("THUOC", "PC", "1"): voucher_part([
+            # Ngày sai → số chứng từ có "_": tách KEY bằng rsplit("_") sẽ ra "A" thay vì "NVK_INVALID_A"
+            ["01/07/2024", "Phạm Minh Dũng", 50000, "NVK_INVALID_A"],
+        ]),
+    }), "T07_2024.xlsx", "A")
+
+    pairs = [
+        ("Nguyễn Văn An", "NVKKCB010724A"),
+        ("Trần_Thị Bình", "NVKKCB010724A"),
+        ("Phạm Minh Dũng", "NVK_INVALID_A"),
+        ("Lê Hữu Cường", "NVKKCB020724A"),  # cùng tên, khác số chứng từ → không lấy
+    ]
+    records = archive.amount_records(pairs=pairs)
+
+    assert sorted(zip(records["TÊN"], records["SỐ CHỨNG TỪ"])) == sorted(pairs[:3])
+    assert set(records["KEY"]) == {f"{ten}_{so_ct}" for ten, so_ct in pairs[:3]}
+    assert set(records["TÊN FILE"]) == {"Kho chứng từ"}
+    assert archive.amount_records(pairs=[]).empty
+    assert len(archive.amount_records()) == 4
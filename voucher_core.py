@@ -0,0 +1,2035 @@
+"""Lõi xử lý tạo file hạch toán: dùng được từ giao diện Streamlit (app.py), từ script khác hoặc từ dòng lệnh.
+
+Chạy không cần Streamlit:
+    python voucher_core.py <thư mục file Excel> --suffix A [--workers 4] [--output TongHop_A.zip] [--archive] [--format csv]
+    python voucher_core.py <thư mục file Zip> --consolidate quarter [--output thư_mục_đầu_ra]
+"""
+import pandas as pd
+import zipfile
+import os
+import sys
+import json
+import argparse
+from io import BytesIO
+import traceback
+import tempfile
+import shutil
+import time
+import sqlite3
+import hashlib
+import csv
+import itertools
+from io import StringIO
+import re
+import numpy as np
+from datetime import datetime
+import multiprocessing
+import xlsxwriter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+import pstats
+import marshal
+import unicodedata
+from difflib import SequenceMatcher
+import pickle
+import glob
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # chưa cài pyarrow → tắt kho chứng từ Parquet
+    pa = ds = None
+
+# ====== HÀM TIỆN ÍCH CHUNG =======
+def extract_month_year_from_filename(filename):
+    try:
+        match = re.search(r'(\d{4})[\.\-_]?\s*(\d{2})|\s*(\d{2})[\.\-_]?\s*(\d{4})', filename)
+        if match:
+            year = match.group(1) or match.group(4)
+            month = match.group(2) or match.group(3)
+            return month, year
+    except: pass
+    return "Tự đặt tên nhé", "Tự đặt tên nhé"
+
+def is_day_sheet(sheet_name):
+    # Sheet ngày của file tháng (và của file PT/PC Tab 1 ghi ra) có tên là số: "1", "15", "1.5"...
+    return sheet_name.replace(".", "", 1).isdigit() or sheet_name.replace(",", "", 1).isdigit()
+
+def to_ddmmyyyy(date_val):
+    try:
+        if pd.isnull(date_val): return ""
+        if isinstance(date_val, (pd.Timestamp, datetime)):
+            return date_val.strftime("%d/%m/%Y")
+        if isinstance(date_val, (float, int)):
+            return pd.to_datetime(date_val, origin='1899-12-30', unit='D').strftime("%d/%m/%Y")
+        if isinstance(date_val, str):
+            parsed = pd.to_datetime(date_val, dayfirst=True, errors='coerce')
+            if pd.isnull(parsed): parsed = pd.to_datetime(date_val, errors='coerce')
+            return parsed.strftime("%d/%m/%Y") if not pd.isnull(parsed) else ""
+        return str(date_val)
+    except: return ""
+
+def format_date_column(series, formatter=to_ddmmyyyy):
+    """Chuẩn hoá cả cột ngày: mỗi giá trị khác nhau chỉ được parse đúng một lần."""
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    formatted = np.array([formatter(v) for v in uniques] + [formatter(np.nan)], dtype=object)
+    return pd.Series(formatted[codes], index=series.index, dtype=object)
+
+def format_name(name):
+    clean = re.split(r'[\n\r\t\u00A0\u2003]+', str(name).strip())[0]
+    clean = re.sub(r'\s+', ' ', clean)
+    return clean.replace("-", "").title()
+
+def format_names(series):
+    """Phiên bản theo cột của format_name."""
+    return (
+        series.map(str).str.strip()
+        .str.split(r'[\n\r\t\u00A0\u2003]+', n=1, regex=True).str[0]
+        .str.replace(r'\s+', ' ', regex=True)
+        .str.replace("-", "", regex=False)
+        .str.title()
+    )
+
+def classify_department(value, content_value=None):
+    val = str(value).upper()
+    if "VACCINE" in val or "VACXIN" in val: return "VACCINE"
+    elif "THUỐC" in val: return "THUOC"
+    elif "THẺ" in val: return "THE"
+    if content_value:
+        content_val = str(content_value).upper()
+        if "VACCINE" in content_val: return "VACCINE"
+        elif "THUỐC" in content_val: return "THUOC"
+    return "KCB"
+
+# Bảng luật phân loại khoa: (cột, từ khoá, nhóm) - xét lần lượt, luật đầu tiên khớp sẽ thắng
+department_rules = [
+    ("KHOA/BỘ PHẬN", ["VACCINE", "VACXIN"], "VACCINE"),
+    ("KHOA/BỘ PHẬN", ["THUỐC"], "THUOC"),
+    ("KHOA/BỘ PHẬN", ["THẺ"], "THE"),
+    ("NỘI DUNG THU", ["VACCINE"], "VACCINE"),
+    ("NỘI DUNG THU", ["THUỐC"], "THUOC"),
+]
+department_categories = ["KCB", "THUOC", "VACCINE", "THE"]
+
+def classify_departments(df, default="KCB"):
+    """Phiên bản theo cột của classify_department, trả về cột categorical."""
+    result = pd.Series(default, index=df.index, dtype=object)
+    decided = pd.Series(False, index=df.index)
+    upper_cols = {}
+    for column, keywords, category in department_rules:
+        if column not in df.columns: continue
+        if column not in upper_cols:
+            upper_cols[column] = df[column].map(str).str.upper()
+        pattern = "|".join(re.escape(k) for k in keywords)
+        hit = ~decided & upper_cols[column].str.contains(pattern, regex=True)
+        result[hit] = category
+        decided |= hit
+    return result.astype(pd.CategoricalDtype(department_categories))
+
+category_info = {
+    "KCB": {"ma": "KHACHLE01", "ten": "Khách hàng lẻ - Khám chữa bệnh"},
+    "THUOC": {"ma": "KHACHLE02", "ten": "Khách hàng lẻ - Bán thuốc"},
+    "VACCINE": {"ma": "KHACHLE03", "ten": "Khách hàng lẻ - Tiêm vacxin"},
+}
+
+output_columns = [
+    "Ngày hạch toán (*)", "Ngày chứng từ (*)", "Số chứng từ (*)",
+    "Mã đối tượng", "Tên đối tượng", "Nộp vào TK", "Mở tại ngân hàng",
+    "Lý do thu", "Diễn giải lý do thu", "Diễn giải (hạch toán)",
+    "TK Nợ (*)", "TK Có (*)", "Số tiền"
+]
+
+# ====== ĐỌC EXCEL =======
+def pick_excel_engine():
+    # python-calamine (nếu đã cài) đọc nhanh hơn nhiều; không có thì dùng openpyxl (read-only) mặc định của pandas
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return None
+
+EXCEL_ENGINE = pick_excel_engine()
+
+class ExcelReader:
+    """Lớp đọc Excel dùng chung cho các tab: chỉ đọc các cột cần và ghi lại thời gian đọc từng sheet."""
+    def __init__(self, source, engine=EXCEL_ENGINE):
+        self.xls = pd.ExcelFile(source, engine=engine)
+        self.engine = engine or "openpyxl"
+        self.sheet_names = self.xls.sheet_names
+        self.timings = {}
+
+    def read(self, sheet_name, columns=None, normalize=lambda c: c):
+        """Đọc 1 sheet; nếu có columns thì dò dòng tiêu đề và chỉ đọc các cột khớp (so sánh sau khi normalize)."""
+        start = time.perf_counter()
+        usecols = None
+        if columns is not None:
+            wanted = {normalize(c) for c in columns}
+            header = self.xls.parse(sheet_name, nrows=0).columns
+            usecols = [i for i, c in enumerate(header) if normalize(c) in wanted]
+        df = self.xls.parse(sheet_name, usecols=usecols)
+        self.timings[sheet_name] = time.perf_counter() - start
+        return df
+
+    def read_all(self):
+        """Đọc mọi sheet trong 1 lần gọi: {tên sheet: DataFrame}; thời gian cả workbook ghi ở timings[None]."""
+        start = time.perf_counter()
+        sheets = self.xls.parse(sheet_name=None)
+        self.timings[None] = time.perf_counter() - start
+        return sheets
+
+# ====== GHI EXCEL =======
+# Từ số dòng này trở lên mới ghi kiểu constant_memory: chuỗi ghi inline nên file nhỏ ghi / đọc lại chậm hơn shared strings
+STREAMING_MIN_ROWS = int(os.environ.get("VOUCHER_STREAMING_ROWS", "20000"))
+
+def column_widths(df, sample=None):
+    """Độ rộng từng cột = max(độ dài tiêu đề, độ dài chuỗi dài nhất) + 2.
+
+    Độ dài tính bằng str.len() trên các giá trị khác nhau của cột; sample=N thì chỉ xét N giá trị ngẫu nhiên (ước lượng).
+    """
+    widths = []
+    for col in df.columns:
+        values = df[col]
+        if sample is not None and len(values) > sample:
+            values = values.sample(sample, random_state=0)
+        uniques = pd.Series(pd.unique(values), dtype=object)
+        longest = uniques.astype(str).str.len().max() if len(uniques) else 0
+        widths.append(max(len(str(col)), int(longest)) + 2)
+    return widths
+
+def frame_rows(df, chunk_size=10000):
+    """Các dòng của df dạng tuple giá trị Python, ô trống (NaN/NaT) thành None để xlsxwriter bỏ qua.
+
+    Đổi kiểu theo từng khối chunk_size dòng để không tạo bản sao object của cả bảng.
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        yield from chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None)
+
+class StreamingWorkbook:
+    """Workbook xlsxwriter ghi từng dòng theo thứ tự; constant_memory=True thì chỉ giữ 1 dòng trong RAM, phần còn lại ở file tạm.
+
+    Định dạng được tạo 1 lần cho cả workbook và dùng lại ở mọi sheet.
+    """
+    def __init__(self, target, constant_memory=True):
+        self.book = xlsxwriter.Workbook(target, {"constant_memory": constant_memory, "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+        self._formats = {}
+
+    def format(self, **props):
+        key = tuple(sorted(props.items()))
+        if key not in self._formats:
+            self._formats[key] = self.book.add_format(props)
+        return self._formats[key]
+
+    def write_frame(self, sheet_name, df, header=None, column_formats=None, widths=None, fit_columns=True, tab_color=None,
+                    fraction_formats=None):
+        """Ghi df (không kèm index) vào sheet mới.
+
+        header / column_formats là dict thuộc tính định dạng xlsxwriter; widths=None thì tự tính bằng column_widths,
+        fit_columns=False thì giữ độ rộng mặc định của Excel.
+        fraction_formats: định dạng riêng cho các ô số có phần lẻ của cột (VD: '#,##0' làm tròn 12345.5 thành 12,346).
+        """
+        worksheet = self.book.add_worksheet(sheet_name)
+        column_formats = column_formats or {}
+        if fit_columns:
+            widths = column_widths(df) if widths is None else widths
+            for i, col in enumerate(df.columns):
+                fmt = column_formats.get(col)
+                worksheet.set_column(i, i, widths[i], self.format(**fmt) if fmt else None)
+        worksheet.write_row(0, 0, [str(c) for c in df.columns], self.format(**header) if header else None)
+        fractions = [(df.columns.get_loc(col), self.format(**fmt)) for col, fmt in (fraction_formats or {}).items() if col in df.columns]
+        for row_num, row in enumerate(frame_rows(df), start=1):
+            worksheet.write_row(row_num, 0, row)
+            # Ghi đè ô lẻ ngay trên dòng đang ghi (constant_memory chỉ cho sửa dòng hiện tại)
+            for i, fmt in fractions:
+                if isinstance(row[i], float) and not row[i].is_integer():
+                    worksheet.write_number(row_num, i, row[i], fmt)
+        if tab_color:
+            worksheet.set_tab_color(tab_color)
+        return worksheet
+
+    def close(self):
+        self.book.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ====== GHI CSV / PARQUET =======
+# Định dạng file đầu ra Tab 1: xlsx (mỗi nhóm PT/PC 1 file, mỗi ngày 1 sheet) hoặc csv / parquet (mỗi ngày 1 file)
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet")
+
+def csv_amounts(series):
+    # Xét từng ô: số nguyên ghi không ".0" (150000) kể cả khi cùng ngày có số lẻ (12345.5 giữ nguyên phần lẻ)
+    values = pd.to_numeric(series, errors="coerce")
+    whole = values.notna() & (values % 1 == 0)
+    out = series.astype(object)
+    out[whole] = values[whole].astype(np.int64).astype(object)
+    return out
+
+def frame_to_csv(df):
+    """CSV UTF-8 có BOM (MISA / Excel nhận đúng tiếng Việt), cột theo output_columns, ngày dd/mm/yyyy, số tiền không dấu phân cách."""
+    df = df[output_columns].assign(**{"Số tiền": csv_amounts(df["Số tiền"])})
+    return df.to_csv(index=False, lineterminator="\r\n").encode("utf-8-sig")
+
+def frame_to_parquet(df):
+    if pa is None:
+        raise RuntimeError("Cần cài pyarrow để xuất file Parquet (pip install pyarrow)")
+    output = BytesIO()
+    df[output_columns].to_parquet(output, index=False)
+    return output.getvalue()
+
+frame_writers = {"csv": frame_to_csv, "parquet": frame_to_parquet}
+
+
+# ====== ĐÍCH GHI ZIP =======
+def member_compression(path):
+    # xlsx / parquet đã nén sẵn bên trong nên lưu nguyên; csv là văn bản nên nén deflate
+    return zipfile.ZIP_DEFLATED if path.endswith(".csv") else zipfile.ZIP_STORED
+
+class ZipSink:
+    """Ghi thẳng từng file kết quả vào một zip duy nhất, kèm tiền tố thư mục.
+
+    Zip nằm trên SpooledTemporaryFile: lô nhỏ giữ trong RAM, lô lớn tự tràn ra đĩa.
+    """
+    def __init__(self, max_memory=64 * 1024 * 1024):
+        self.prefix = ""
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._zip = zipfile.ZipFile(self._file, "w")
+
+    def with_prefix(self, prefix):
+        child = object.__new__(ZipSink)
+        child.prefix = f"{self.prefix}{prefix.strip('/')}/"
+        child._file, child._zip = self._file, self._zip
+        return child
+
+    def writestr(self, path, data):
+        self._zip.writestr(f"{self.prefix}{path}", data, compress_type=member_compression(path))
+
+    def close(self):
+        """Đóng zip và trả về file tạm đã tua về đầu để tải xuống."""
+        self._zip.close()
+        self._file.seek(0)
+        return self._file
+
+class SpooledResult:
+    """Kết quả lớn (VD: zip Tab 1) giữ nguyên trên file tạm của ZipSink thay vì chép ra bytes; chỉ đọc ra khi tải xuống."""
+    def __init__(self, file):
+        self.file = file
+        self.size = file.seek(0, os.SEEK_END)
+        self.lock = threading.Lock()
+
+    def read(self):
+        # Nhiều phiên có thể cùng tải 1 kết quả: đọc từ đầu dưới khoá
+        with self.lock:
+            self.file.seek(0)
+            return self.file.read()
+
+class MemberListSink:
+    """Gom file kết quả thành list (đường dẫn, bytes) - dùng trong tiến trình con rồi chuyển về ZipSink."""
+    def __init__(self):
+        self.members = []
+
+    def writestr(self, path, data):
+        self.members.append((path, data))
+
+source_columns = ["KHOA/BỘ PHẬN", "TRẢ THẺ", "NGÀY QUỸ", "NGÀY KHÁM", "HỌ VÀ TÊN", "NỘI DUNG THU"]
+
+# ====== BỘ NHỚ ĐỆM KẾT QUẢ =======
+CACHE_MAX_BYTES = int(os.environ.get("VOUCHER_CACHE_MB", "256")) * 1024 * 1024
+
+def content_key(*parts):
+    """Khoá SHA-256 từ nội dung file (bytes) và các tham số (tab, hậu tố, tuỳ chọn...)."""
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else repr(part).encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def approx_size(value):
+    """Ước lượng số byte bộ nhớ của 1 kết quả (bytes, DataFrame/Series, Metrics, tuple/list/dict lồng nhau)."""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sum(approx_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, Metrics):
+        return approx_size(value.records)
+    if isinstance(value, SpooledResult):
+        return value.size  # tính cả phần đã tràn ra đĩa: giới hạn luôn dung lượng file tạm giữ lại
+    return sys.getsizeof(value)
+
+class ResultCache:
+    """Bộ nhớ đệm LRU giới hạn theo tổng dung lượng: giữ kết quả đã xử lý (DataFrame, bytes file tải về) qua các lần rerun.
+
+    Kết quả lớn hơn cả giới hạn thì không được giữ lại.
+    """
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value):
+        size = approx_size(value)
+        if key in self._items:
+            self.size -= self._items.pop(key)[1]
+        if size > self.max_bytes:
+            return value
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, old_size) = self._items.popitem(last=False)
+            self.size -= old_size
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        return value if value is not None else self.put(key, compute())
+
+    def __len__(self):
+        return len(self._items)
+
+
+# ====== ĐO THỜI GIAN / BỘ NHỚ =======
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class RssSampler:
+    """Luồng nền đọc RSS mỗi `interval` giây, nâng đỉnh RSS của mọi bước đang đo.
+
+    ru_maxrss là đỉnh cả đời tiến trình (bước sau luôn ≥ bước trước), không cho biết bước nào tốn bộ nhớ.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Bắt đầu theo dõi 1 bước; trả về [RSS lúc bắt đầu, đỉnh] (None nếu không đọc được RSS)."""
+        rss = current_rss_mb()
+        if rss is None:
+            return None
+        peak = [rss, rss]
+        with self.lock:
+            self.active[id(peak)] = peak
+            # Tạo luồng khi cần (tiến trình con fork ra không mang theo luồng của tiến trình cha)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self.thread.start()
+            self.wake.set()
+        return peak
+
+    def stop(self, peak):
+        """Kết thúc theo dõi; trả về (RSS lúc bắt đầu, RSS đỉnh trong bước)."""
+        if peak is None:
+            return None, None
+        rss = current_rss_mb()
+        with self.lock:
+            self.active.pop(id(peak), None)
+            if not self.active:
+                self.wake.clear()  # không còn bước nào đang đo → luồng nền đứng chờ
+            if rss is not None:
+                peak[1] = max(peak[1], rss)
+        return peak[0], peak[1]
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            rss = current_rss_mb()
+            if rss is not None:
+                with self.lock:
+                    for peak in self.active.values():
+                        peak[1] = max(peak[1], rss)
+            time.sleep(self.interval)
+
+rss_sampler = RssSampler()
+
+metric_columns = ["file", "stage", "sheet", "rows", "seconds", "rows_per_sec", "rss_mb", "stage_peak_rss_mb", "stage_mem_mb"]
+
+class Metrics:
+    """Ghi thời gian, số dòng/giây và bộ nhớ theo từng bước, từng sheet.
+
+    rss_mb: RSS lúc bước kết thúc; stage_peak_rss_mb: RSS cao nhất trong lúc chạy bước (lấy mẫu ~10ms);
+    stage_mem_mb: stage_peak_rss_mb trừ RSS lúc bước bắt đầu (bộ nhớ bước đó cần thêm).
+    """
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, sheet=None, rows=None):
+        """Đo 1 bước; bên trong khối with có thể gán record["rows"] khi đến cuối mới biết số dòng."""
+        record = {"stage": name, "sheet": sheet, "rows": rows}
+        sample = rss_sampler.start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            rss_start, peak = rss_sampler.stop(sample)
+            rss = current_rss_mb()
+            record["seconds"] = round(seconds, 4)
+            record["rows_per_sec"] = round(record["rows"] / seconds) if record["rows"] and seconds > 0 else None
+            record["rss_mb"] = round(rss, 1) if rss is not None else None
+            record["stage_peak_rss_mb"] = round(peak, 1) if peak is not None else None
+            record["stage_mem_mb"] = round(peak - rss_start, 1) if peak is not None else None
+            self.records.append(record)
+
+    def extend(self, records, **extra):
+        self.records.extend({**extra, **record} for record in records)
+
+    def to_frame(self):
+        df = pd.DataFrame(self.records)
+        return df[[c for c in metric_columns if c in df.columns]]
+
+    def summary(self):
+        """Tổng hợp theo bước: số lần, tổng giây, tổng dòng, dòng/giây, RSS đỉnh và bộ nhớ thêm lớn nhất trong các lần chạy."""
+        df = self.to_frame()
+        if df.empty:
+            return pd.DataFrame(columns=["stage", "lan", "seconds", "rows", "rows_per_sec", "stage_peak_rss_mb", "stage_mem_mb"])
+        summary = df.groupby("stage", sort=False).agg(
+            lan=("stage", "size"), seconds=("seconds", "sum"), rows=("rows", "sum"),
+            stage_peak_rss_mb=("stage_peak_rss_mb", "max"), stage_mem_mb=("stage_mem_mb", "max"),
+        ).reset_index()
+        summary["seconds"] = summary["seconds"].round(3)
+        summary["rows_per_sec"] = (summary["rows"] / summary["seconds"]).where(summary["seconds"] > 0).round()
+        return summary[["stage", "lan", "seconds", "rows", "rows_per_sec", "stage_peak_rss_mb", "stage_mem_mb"]]
+
+    def to_json(self):
+        return json.dumps(
+            {"summary": self.summary().to_dict("records"), "stages": self.records},
+            ensure_ascii=False, indent=2, default=str,
+        )
+
+def profile_call(func, *args, **kwargs):
+    """Chạy func dưới cProfile; trả về (kết quả, bytes .prof đọc được bằng pstats/snakeviz, 30 hàm tốn thời gian nhất)."""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    profiler.create_stats()
+    # Lấy bytes trước: pstats.Stats(profiler) lấy đi profiler.stats
+    prof_bytes = marshal.dumps(profiler.stats)
+    text = StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(30)
+    return result, prof_bytes, text.getvalue()
+
+
+# ====== CHẠY NỀN (JOB) =======
+JOB_WORKERS = int(os.environ.get("VOUCHER_JOB_WORKERS", "2"))
+
+class JobCancelled(Exception):
+    """Job đã bị người dùng huỷ; được ném ra từ lần báo tiến độ kế tiếp của hàm đang chạy."""
+
+class Job:
+    """1 lượt xử lý chạy nền: trạng thái, tiến độ, kết quả / lỗi; tra lại được bằng id.
+
+    status: queued → running → done / error / cancelled (expired khi kết quả bị xoá khỏi bộ nhớ).
+    """
+    def __init__(self, name, key=None):
+        # Đủ dài để không đoán được: có id là xem / tải được kết quả
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.key = key
+        self.status = "queued"
+        self.done, self.total, self.message = 0, 0, ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+
+    def progress(self, done=None, total=None, message=None):
+        """Báo tiến độ (done / total, chấp nhận số lẻ); ném JobCancelled nếu job đã bị huỷ."""
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+
+    @property
+    def fraction(self):
+        if self.status == "done":
+            return 1.0
+        return min(max(self.done / self.total, 0.0), 1.0) if self.total else 0.0
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def cancel(self):
+        self._cancel.set()
+
+
+class JobRunner:
+    """Hàng đợi job dùng chung cho mọi phiên: tối đa max_workers job chạy cùng lúc, job sau xếp hàng.
+
+    Kết quả job xong được giữ trên Job (tổng dung lượng tối đa max_bytes, job cũ nhất bị xoá kết quả trước)
+    nên tải lại trang / rerun vẫn lấy lại được theo id.
+    """
+    def __init__(self, max_workers=JOB_WORKERS, max_bytes=CACHE_MAX_BYTES, max_jobs=200):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="voucher-job")
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, name, func, *args, key=None, **kwargs):
+        """Chạy func(*args, progress=job.progress, **kwargs) ở luồng nền và trả về Job.
+
+        Đã có job cùng key đang chạy hoặc còn kết quả thì trả về job đó thay vì chạy lại.
+        """
+        with self.lock:
+            if key is not None:
+                for job in self.jobs.values():
+                    if job.key == key and (job.active or job.status == "done"):
+                        return job
+            job = Job(name, key)
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if not j.active]
+            for old in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[old.id]
+        self.pool.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        try:
+            job.progress(message="Đang bắt đầu")
+            job.status = "running"
+            job.result = func(*args, progress=job.progress, **kwargs)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception:
+            job.error = traceback.format_exc()
+            job.status = "error"
+        finally:
+            job.finished = time.time()
+            self._trim()
+
+    def _trim(self):
+        # Giữ kết quả mới nhất, bỏ kết quả cũ khi vượt quá dung lượng
+        with self.lock:
+            done = [job for job in reversed(self.jobs.values()) if job.status == "done"]
+            total = 0
+            for i, job in enumerate(done):
+                total += approx_size(job.result)
+                if i and total > self.max_bytes:
+                    job.result, job.status = None, "expired"
+
+    def get(self, job_id):
+        return self.jobs.get(job_id) if job_id else None
+
+    def active_count(self):
+        with self.lock:
+            return sum(job.active for job in self.jobs.values())
+
+    def to_frame(self, ids=None):
+        """Bảng các job (mới nhất trước) để hiển thị; ids: chỉ lấy các job này (VD: job của 1 phiên), None = tất cả."""
+        with self.lock:
+            jobs = [job for job in reversed(self.jobs.values()) if ids is None or job.id in ids]
+        return pd.DataFrame([{
+            "id": job.id, "job": job.name, "status": job.status, "progress": round(job.fraction * 100),
+            "message": job.message, "created": datetime.fromtimestamp(job.created).strftime("%H:%M:%S"),
+            "seconds": round((job.finished or time.time()) - job.created, 1),
+        } for job in jobs], columns=["id", "job", "status", "progress", "message", "created", "seconds"])
+
+
+# ====== XỬ LÝ LẠI THEO NGÀY (TĂNG DẦN) =======
+INCREMENTAL_STORE_PATH = os.environ.get("VOUCHER_INCREMENTAL_STORE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "incremental.sqlite"))
+# Tăng số này khi đổi cách tạo chứng từ / ghi file để bỏ qua kết quả cũ trong kho
+INCREMENTAL_VERSION = 1
+
+def sheet_digest(df):
+    """SHA-256 nội dung 1 sheet đã đọc (tên cột + giá trị từng ô)."""
+    h = hashlib.sha256(repr(list(df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+class IncrementalStore:
+    """Kho SQLite nhớ kết quả Tab 1 theo nội dung từng sheet ngày, để lần tải lại chỉ xử lý các ngày đã thay đổi.
+
+    - days: khoá ngày (hash sheet + tên sheet + hậu tố + POS) → các phần PT/PC của ngày đó và log cảnh báo.
+    - workbooks: khoá các ngày của 1 file (nhóm, PT/PC) → bytes xlsx đã ghi, dùng lại khi không ngày nào đổi.
+    Mục không được dùng quá max_age_days ngày sẽ bị xoá khi mở kho.
+    """
+    def __init__(self, path=INCREMENTAL_STORE_PATH, max_age_days=90):
+        self.path = path
+        self.con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.con:
+            self.con.executescript("""
+                CREATE TABLE IF NOT EXISTS days (key TEXT PRIMARY KEY, data BLOB NOT NULL, last_used TEXT);
+                CREATE TABLE IF NOT EXISTS workbooks (key TEXT PRIMARY KEY, data BLOB NOT NULL, last_used TEXT);
+            """)
+            for table in ("days", "workbooks"):
+                self.con.execute(f"DELETE FROM {table} WHERE last_used < datetime('now', ?)", (f"-{max_age_days} days",))
+
+    def _get(self, table, key):
+        row = self.con.execute(f"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with self.con:
+            self.con.execute(f"UPDATE {table} SET last_used = datetime('now') WHERE key = ?", (key,))
+        return row[0]
+
+    def _put(self, table, key, data):
+        with self.con:
+            self.con.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, datetime('now'))", (key, data))
+
+    def get_day(self, key):
+        """(phần PT/PC {(nhóm, PT/PC): DataFrame}, log cảnh báo) của ngày, hoặc None nếu chưa có."""
+        data = self._get("days", key)
+        return pickle.loads(data) if data is not None else None
+
+    def put_day(self, key, parts, warnings):
+        self._put("days", key, pickle.dumps((parts, warnings), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get_workbook(self, key):
+        return self._get("workbooks", key)
+
+    def put_workbook(self, key, data):
+        self._put("workbooks", key, data)
+
+    def close(self):
+        self.con.close()
+
+
+# ====== KHO CHỨNG TỪ (PARQUET) =======
+ARCHIVE_PATH = os.environ.get("VOUCHER_ARCHIVE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "voucher_archive"))
+ARCHIVE_AVAILABLE = pa is not None
+
+archive_columns = ["ngay", "nhom", "loai", "ten", "ten_chuan", "so_tien", "so_ct", "nguon", "sheet", "hau_to", "nam", "thang"]
+
+def archive_schema():
+    return pa.schema([
+        ("ngay", pa.date32()), ("nhom", pa.string()), ("loai", pa.string()),
+        ("ten", pa.string()), ("ten_chuan", pa.string()), ("so_tien", pa.float64()),
+        ("so_ct", pa.string()), ("nguon", pa.string()), ("sheet", pa.string()), ("hau_to", pa.string()),
+        ("nam", pa.int16()), ("thang", pa.int8()),
+    ])
+
+def archive_partitioning():
+    return ds.partitioning(pa.schema([("nam", pa.int16()), ("thang", pa.int8())]), flavor="hive")
+
+def archive_frame(partitions):
+    """Các phần chứng từ Tab 1 {(nhóm, PT/PC, sheet): bảng} → bảng 1 dòng / chứng từ theo cột của kho (chưa có nguồn, hậu tố)."""
+    parts = [
+        pd.DataFrame({
+            "ngay": part["Ngày chứng từ (*)"], "nhom": category, "loai": mode, "ten": part["Tên đối tượng"],
+            "so_tien": part["Số tiền"], "so_ct": part["Số chứng từ (*)"], "sheet": str(day),
+        })
+        for (category, mode, day), part in partitions.items()
+    ]
+    if not parts:
+        return pd.DataFrame(columns=[c for c in archive_columns if c not in ("nguon", "hau_to")])
+    df = pd.concat(parts, ignore_index=True)
+    ngay = pd.to_datetime(df["ngay"], format="%d/%m/%Y", errors="coerce")
+    df["ngay"] = ngay.astype("datetime64[s]")
+    df["ten_chuan"] = df["ten"].str.strip().str.lower().str.replace(r"\s+", " ", regex=True)
+    df["so_tien"] = df["so_tien"].astype(float)
+    df["nam"] = ngay.dt.year.astype("Int16")
+    df["thang"] = ngay.dt.month.astype("Int8")
+    return df
+
+def archive_filter(**filters):
+    """Biểu thức lọc pyarrow: giá trị đơn (==), list / set (thuộc tập), tuple (từ, đến) kể cả 2 đầu; None = không lọc.
+
+    Điều kiện trên nam / thang chỉ mở thư mục tháng tương ứng; điều kiện trên cột khác được đẩy xuống lúc đọc Parquet
+    (bỏ qua cả row group theo thống kê min / max) thay vì đọc hết rồi mới lọc.
+    """
+    expr = None
+    for column, value in filters.items():
+        if value is None:
+            continue
+        field = ds.field(column)
+        if isinstance(value, tuple):
+            low, high = value
+            cond = (field >= low) & (field <= high)
+        elif isinstance(value, (list, set, frozenset, np.ndarray, pd.Index)):
+            # Tập rỗng: pyarrow không đoán được kiểu của isin([]) → không dòng nào thoả
+            cond = field.isin(list(value)) if len(value) else ds.scalar(False)
+        else:
+            cond = field == value
+        expr = cond if expr is None else expr & cond
+    return expr
+
+class VoucherArchive:
+    """Kho Parquet các dòng chứng từ Tab 1 trên máy, chia thư mục nam=/thang= để truy vấn nhiều tháng không phải tải lại file xlsx.
+
+    Mỗi lần ghi của 1 file nguồn (tên file + hậu tố) là 1 nhóm file Parquet riêng: xử lý lại cùng file thì dữ liệu cũ được thay.
+    Chỉ giữ đường dẫn nên gửi được sang tiến trình con (ghi song song từ nhiều tiến trình, mỗi nguồn 1 nhóm file).
+
+        kho = VoucherArchive()
+        kho.query(ten_chuan="nguyễn văn an")                                        # bệnh nhân đã có chứng từ chưa
+        kho.totals(["nhom"], nhom="THUOC", loai="PC", nam=2024, thang=(4, 6))    # tổng phiếu chi THUOC quý 2
+    """
+    def __init__(self, path=ARCHIVE_PATH):
+        if pa is None:
+            raise RuntimeError("Cần cài pyarrow để dùng kho chứng từ Parquet (pip install pyarrow)")
+        self.path = path
+
+    def append(self, frame, source, chu_hau_to):
+        """Ghi bảng archive_frame của 1 file nguồn, thay lần ghi trước của cùng file + hậu tố. Trả về số dòng đã ghi."""
+        tag = content_key("archive", source, chu_hau_to)[:16]
+        for old in glob.glob(os.path.join(glob.escape(self.path), "*", "*", f"{tag}-*.parquet")):
+            os.remove(old)
+        if frame.empty:
+            return 0
+        table = pa.Table.from_pandas(
+            frame.assign(nguon=source, hau_to=chu_hau_to)[archive_columns], schema=archive_schema(), preserve_index=False,
+        )
+        ds.write_dataset(
+            table, self.path, format="parquet", partitioning=archive_partitioning(),
+            basename_template=f"{tag}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore",
+        )
+        return len(frame)
+
+    def stamp(self):
+        """Dấu thay đổi của kho (tên, cỡ, thời điểm sửa các file Parquet), dùng làm khoá bộ nhớ đệm kết quả."""
+        files = sorted(glob.glob(os.path.join(glob.escape(self.path), "*", "*", "*.parquet")))
+        return content_key(*[(f, os.path.getsize(f), os.path.getmtime(f)) for f in files])
+
+    def _table(self, columns=None, filter=None):
+        schema = archive_schema()
+        if not os.path.isdir(self.path):
+            return schema.empty_table().select(columns or schema.names)
+        dataset = ds.dataset(self.path, format="parquet", schema=schema, partitioning=archive_partitioning())
+        return dataset.to_table(columns=columns, filter=filter)
+
+    def query(self, columns=None, **filters):
+        """Các dòng thoả điều kiện (xem archive_filter), VD: query(nhom="KCB", nam=2024, ngay=(date(2024, 7, 1), date(2024, 7, 15)))."""
+        return self._table(columns, archive_filter(**filters)).to_pandas()
+
+    def totals(self, by=("nam", "thang", "nhom", "loai"), **filters):
+        """Tổng tiền và số dòng theo các cột by của các dòng thoả điều kiện; cộng dồn ngay trên bảng Arrow."""
+        by = list(by)
+        table = self._table(by + ["so_tien"], archive_filter(**filters))
+        result = table.group_by(by).aggregate([("so_tien", "sum"), ("so_tien", "count")]).to_pandas()
+        result = result.rename(columns={"so_tien_sum": "Tổng tiền", "so_tien_count": "Số dòng"})
+        return result[by + ["Tổng tiền", "Số dòng"]].sort_values(by).reset_index(drop=True)
+
+    def sources(self):
+        """Các file nguồn đã lưu: số dòng, ngày chứng từ đầu / cuối."""
+        table = self._table(["nguon", "hau_to", "ngay", "so_tien"])
+        result = table.group_by(["nguon", "hau_to"]).aggregate([("so_tien", "count"), ("ngay", "min"), ("ngay", "max")]).to_pandas()
+        return result.rename(columns={
+            "nguon": "File nguồn", "hau_to": "Hậu tố", "so_tien_count": "Số dòng", "ngay_min": "Từ ngày", "ngay_max": "Đến ngày",
+        })[["File nguồn", "Hậu tố", "Số dòng", "Từ ngày", "Đến ngày"]].sort_values(["File nguồn", "Hậu tố"]).reset_index(drop=True)
+
+    def lookup(self, dates, exclude_sources=()):
+        """Tập khoá (tên chuẩn, ngày dd/mm/yyyy, số tiền) của các ngày cần so — cùng dạng BaseKeyStore.lookup, dùng cho Tab 2.
+
+        exclude_sources: bỏ qua các file nguồn này (VD: chính file tháng đang xoá trùng).
+        """
+        days = pd.to_datetime(pd.Series(list(dates), dtype=object), format="%d/%m/%Y", errors="coerce").dropna().unique()
+        if not len(days):
+            return set()
+        days = pd.DatetimeIndex(days)
+        expr = archive_filter(ngay=list(days.date), nam=sorted(set(days.year)), thang=sorted(set(days.month)))
+        if exclude_sources:
+            expr = expr & ~ds.field("nguon").isin(list(exclude_sources))
+        df = self._table(["ten_chuan", "ngay", "so_tien"], expr).to_pandas()
+        labels = {day: day.strftime("%d/%m/%Y") for day in days.date}
+        return set(zip(df["ten_chuan"], df["ngay"].map(labels), df["so_tien"]))
+
+    def amount_records(self, pairs=None, label="Kho chứng từ", **filters):
+        """Các dòng của kho dạng bảng dài của Tab 4 (KEY = Tên đối tượng + "_" + Số chứng từ), cả kho tính là 1 file tên label.
+
+        pairs: chỉ lấy các cặp (tên, số chứng từ) này (VD: cột TÊN, SỐ CHỨNG TỪ của collect_amount_records);
+        số chứng từ được lọc ngay khi đọc Parquet. Không tách ngược từ KEY vì tên / số chứng từ có thể chứa "_".
+        """
+        if pairs is not None:
+            pairs = pd.MultiIndex.from_tuples(list(pairs), names=["ten", "so_ct"]).unique()
+            filters["so_ct"] = set(pairs.get_level_values("so_ct"))
+        df = self.query(["ten", "so_ct", "so_tien", "nguon", "sheet"], **filters)
+        ten = df["ten"].str.strip()
+        records = pd.DataFrame({
+            "KEY": ten + "_" + df["so_ct"],
+            "TÊN": ten,
+            "SỐ CHỨNG TỪ": df["so_ct"],
+            "SỐ TIỀN GỐC": df["so_tien"].astype(float),
+            "TÊN FILE": label,
+            "TÊN SHEET": df["nguon"] + " | " + df["sheet"],
+        })
+        if pairs is not None:
+            records = records[pd.MultiIndex.from_arrays([records["TÊN"], records["SỐ CHỨNG TỪ"]]).isin(pairs)]
+        return records.reset_index(drop=True)
+
+
+# ====== XỬ LÝ 1 FILE =======
+def build_voucher_frame(month, chu_hau_to, has_pos):
+    """Tính các cột chứng từ cho toàn bộ dòng của tháng một lần (đã có CATEGORY, NGÀY CHUẨN, TRẢ THẺ, HỌ VÀ TÊN)."""
+    out = pd.DataFrame(index=month.index)
+    category = month["CATEGORY"].astype(str)
+    is_pt = month["TRẢ THẺ"] > 0
+    out["MODE"] = pd.Series(np.where(is_pt, "PT", "PC"), index=month.index)
+    out["CATEGORY"] = month["CATEGORY"]
+    out["SHEET"] = month["SHEET"]
+
+    ngay = month["NGÀY CHUẨN"]
+    parts = ngay.str.extract(r'^([^/]*)/([^/]*)/([^/]*)$')
+    so_ct = "NVK" + category + parts[0].str.zfill(2) + parts[1].str.zfill(2) + parts[2] + chu_hau_to
+    out["Ngày hạch toán (*)"] = ngay
+    out["Ngày chứng từ (*)"] = ngay
+    out["Số chứng từ (*)"] = so_ct.where(parts[0].notna(), f"NVK_INVALID_{chu_hau_to}")
+    out["Mã đối tượng"] = category.map({cat: info["ma"] for cat, info in category_info.items()})
+    out["Tên đối tượng"] = format_names(month["HỌ VÀ TÊN"])
+    out["Nộp vào TK"] = "1290153594"
+    out["Mở tại ngân hàng"] = "Ngân hàng TMCP Đầu tư và Phát triển Việt Nam - Hoàng Mai"
+    out["Lý do thu"] = ""
+    ten_dv = category.map({cat: info["ten"].split("-")[-1].strip().lower() for cat, info in category_info.items()})
+    pos_phrase = " qua pos" if has_pos else ""
+    out["Diễn giải lý do thu"] = pd.Series(np.where(is_pt, "Thu tiền", "Chi tiền"), index=month.index) + " " + ten_dv + f"{pos_phrase} ngày " + ngay
+    out["TK Nợ (*)"] = "1368" if has_pos else "1121"
+    out["Diễn giải (hạch toán)"] = out["Diễn giải lý do thu"] + " " + out["Tên đối tượng"]
+    out["TK Có (*)"] = "131"
+    out["Số tiền"] = month["TRẢ THẺ"].abs()
+    return out
+
+def process_single_file(uploaded_file, chu_hau_to, prefix, sink=None, metrics=None, store=None, progress=None, archive=None,
+                        output_format="xlsx"):
+    """Sinh các file PT/PC theo nhóm và ghi vào sink (mặc định: zip mới trong bộ nhớ).
+
+    Trả về (sink, logs); khi không truyền sink thì trả về (BytesIO chứa zip, logs).
+    Truyền metrics (Metrics) để ghi thời gian từng bước / từng sheet.
+    Truyền store (IncrementalStore) để chỉ xử lý lại các sheet ngày có nội dung khác lần trước.
+    Truyền archive (VoucherArchive) để lưu các dòng chứng từ vào kho Parquet (thay lần lưu trước của cùng file + hậu tố).
+    output_format: "xlsx" → <prefix>_<nhóm>/<PT|PC>.xlsx mỗi ngày 1 sheet; "csv" / "parquet" → <prefix>_<nhóm>/<PT|PC>/<ngày>.csv
+    (ghi nhanh hơn nhiều, để nhập MISA; Tab 3 đọc được cả hai kiểu).
+    progress(done, total, message): báo tiến độ theo sheet (VD: Job.progress).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Định dạng đầu ra không hỗ trợ: {output_format} (chọn 1 trong {', '.join(OUTPUT_FORMATS)})")
+    metrics = metrics if metrics is not None else Metrics()
+    progress = progress or (lambda *args: None)
+    sheet_logs = {}
+    day_keys = {}
+    reused = {}
+    file_name = uploaded_file.name
+    thang, nam = extract_month_year_from_filename(file_name)
+    has_pos = int(nam) <= 2022 if nam.isdigit() else True
+
+    # Đọc & lọc từng sheet ngày, sau đó gộp cả tháng thành 1 bảng
+    frames = []
+    reader = ExcelReader(uploaded_file)
+    steps = len(reader.sheet_names) + 1
+    for i, sheet_name in enumerate(reader.sheet_names):
+        progress(i, steps, f"Sheet {sheet_name}")
+        logs = sheet_logs.setdefault(sheet_name, [])
+        if not is_day_sheet(sheet_name):
+            logs.append(f"⏩ Bỏ qua sheet: {sheet_name}")
+            continue
+        with metrics.stage("Đọc sheet", sheet_name) as record:
+            df = reader.read(sheet_name, source_columns, normalize=lambda c: str(c).strip().upper())
+            record["rows"] = len(df)
+        logs.append(f"⏱️ Đọc sheet {sheet_name}: {reader.timings[sheet_name]:.2f}s ({reader.engine})")
+        df.columns = [str(col).strip().upper() for col in df.columns]
+        if store is not None:
+            day_keys[sheet_name] = content_key("day", INCREMENTAL_VERSION, sheet_name, chu_hau_to, has_pos, sheet_digest(df))
+            cached = store.get_day(day_keys[sheet_name])
+            if cached is not None:
+                reused[sheet_name], warnings = cached
+                logs.extend(warnings)
+                continue
+        if "KHOA/BỘ PHẬN" not in df.columns or "TRẢ THẺ" not in df.columns:
+            logs.append(f"⚠️ Thiếu cột ở sheet {sheet_name}")
+            continue
+        date_column = 'NGÀY QUỸ' if 'NGÀY QUỸ' in df.columns else 'NGÀY KHÁM'
+        if date_column not in df.columns:
+            logs.append(f"⚠️ Không có cột ngày: {date_column}")
+            continue
+
+        with metrics.stage("Lọc + phân loại", sheet_name, len(df)):
+            df["TRẢ THẺ"] = pd.to_numeric(df["TRẢ THẺ"], errors="coerce")
+            df = df[df["TRẢ THẺ"].notna() & (df["TRẢ THẺ"] != 0)]
+            df = df[df[date_column].notna() & (df[date_column] != "-")]
+            df = df[df["HỌ VÀ TÊN"].notna() & (df["HỌ VÀ TÊN"] != "-")]
+
+            df["CATEGORY"] = classify_departments(df)
+            df = df[df["CATEGORY"].isin(list(category_info))]
+        frames.append(pd.DataFrame({
+            "SHEET": sheet_name,
+            "CATEGORY": df["CATEGORY"],
+            "NGÀY": df[date_column],
+            "TRẢ THẺ": df["TRẢ THẺ"],
+            "HỌ VÀ TÊN": df["HỌ VÀ TÊN"],
+        }))
+
+    # Tính cột chứng từ 1 lần cho cả tháng rồi chia nhóm (nhóm, PT/PC, ngày) bằng 1 lần groupby
+    partitions = {}
+    if frames:
+        month = pd.concat(frames, ignore_index=True)
+        with metrics.stage("Chuẩn hoá ngày", rows=len(month)):
+            month["NGÀY CHUẨN"] = format_date_column(month["NGÀY"])
+        with metrics.stage("Tạo chứng từ", rows=len(month)):
+            vouchers = build_voucher_frame(month, chu_hau_to, has_pos)
+            for (category, mode, day), group in vouchers.groupby(["CATEGORY", "MODE", "SHEET"], observed=True, sort=False):
+                partitions[(category, mode, day)] = group[output_columns].reset_index(drop=True)
+
+    if store is not None:
+        # Lưu kết quả các ngày vừa xử lý (kể cả sheet bị bỏ qua vì thiếu cột) rồi ghép với các ngày dùng lại
+        for day, key in day_keys.items():
+            if day in reused:
+                continue
+            parts = {(cat, m): part for (cat, m, d), part in partitions.items() if d == day}
+            store.put_day(key, parts, [line for line in sheet_logs[day] if line.startswith("⚠️")])
+        for day, parts in reused.items():
+            for (category, mode), part in parts.items():
+                partitions[(category, mode, day)] = part
+
+    logs = []
+    for day, lines in sheet_logs.items():
+        logs.extend(lines)
+        if day in reused:
+            logs.append(f"♻️ {day}: sheet không đổi, dùng lại kết quả lần trước")
+        elif day in day_keys:
+            logs.append(f"🔁 {day}: xử lý lại")
+        for category in category_info:
+            for mode in ["PT", "PC"]:
+                if (category, mode, day) in partitions:
+                    logs.append(f"✅ {day} ({category}) [{mode}]: {len(partitions[(category, mode, day)])} dòng")
+
+    if store is not None:
+        rebuilt = [day for day in day_keys if day not in reused]
+        logs.append(
+            f"🔁 Đã xử lý lại {len(rebuilt)} ngày: {', '.join(rebuilt) or 'không có'}"
+            f" | ♻️ dùng lại {len(reused)} ngày"
+        )
+
+    if archive is not None:
+        with metrics.stage("Lưu kho chứng từ") as record:
+            record["rows"] = archive.append(archive_frame(partitions), file_name, chu_hau_to)
+        logs.append(f"🗄️ Đã lưu {record['rows']} dòng vào kho chứng từ")
+
+    # Ghi thẳng số tiền dạng số (không qua công thức =VALUE rồi mở lại bằng openpyxl)
+    progress(steps - 1, steps, f"Ghi file {output_format}")
+    zip_buffer = None
+    if sink is None:
+        zip_buffer = BytesIO()
+        sink = zipfile.ZipFile(zip_buffer, "w", compression=member_compression(f".{output_format}"))
+    for category in category_info:
+        for mode in ["PT", "PC"]:
+            days = sorted(day for cat, m, day in partitions if cat == category and m == mode)
+            if not days: continue
+            n_rows = sum(len(partitions[(category, mode, day)]) for day in days)
+            if output_format != "xlsx":
+                with metrics.stage(f"Ghi {output_format}", f"{category}/{mode}", n_rows):
+                    for day in days:
+                        sink.writestr(
+                            f"{prefix}_{category}/{mode}/{day.strip()}.{output_format}",
+                            frame_writers[output_format](partitions[(category, mode, day)]),
+                        )
+                continue
+            file_path = f"{prefix}_{category}/{mode}.xlsx"
+            workbook_key = None
+            if store is not None:
+                # Mọi ngày của file đều không đổi → dùng lại nguyên file xlsx đã ghi lần trước
+                workbook_key = content_key("workbook", INCREMENTAL_VERSION, category, mode, [day_keys[day] for day in days])
+                data = store.get_workbook(workbook_key)
+                if data is not None:
+                    sink.writestr(file_path, data)
+                    logs.append(f"♻️ {category} [{mode}]: dùng lại file đã tạo")
+                    continue
+            with metrics.stage("Ghi xlsx", f"{category}/{mode}", n_rows):
+                output = BytesIO()
+                with StreamingWorkbook(output, constant_memory=n_rows >= STREAMING_MIN_ROWS) as workbook:
+                    for day in days:
+                        workbook.write_frame(
+                            day.strip(), partitions[(category, mode, day)],
+                            header={'bold': True, 'bg_color': '#D9E1F2', 'border': 1},
+                            column_formats={"Số tiền": {'num_format': '#,##0'}},
+                            fraction_formats={"Số tiền": {'num_format': '#,##0.##'}},
+                            tab_color='#92D050',
+                        )
+                sink.writestr(file_path, output.getvalue())
+                if workbook_key is not None:
+                    store.put_workbook(workbook_key, output.getvalue())
+
+    if zip_buffer is None:
+        return sink, logs
+    sink.close()
+    zip_buffer.seek(0)
+    return zip_buffer, logs
+
+
+# ====== XỬ LÝ NHIỀU FILE (SONG SONG) =======
+def process_pool(max_workers, initializer=None, initargs=()):
+    # Không fork thẳng từ server Streamlit / JobRunner (nhiều luồng: tiến trình con có thể kẹt ở khoá do luồng khác giữ).
+    # forkserver: tiến trình con được fork từ 1 server đơn luồng đã nạp sẵn module này; không có thì spawn.
+    # Hàm, tham số và initargs gửi sang bằng pickle (chỉ cần voucher_core), nhưng mỗi tiến trình con vẫn chạy lại script chính
+    # dưới tên __mp_main__ (với Streamlit là app.py): script chính phải bỏ qua phần giao diện khi __name__ == "__mp_main__".
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+        mp_context.set_forkserver_preload([__name__])
+    else:
+        mp_context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=initializer, initargs=initargs)
+
+def wait_with_progress(pool, futures, progress, unit="file"):
+    """Chờ các future xong, báo tiến độ mỗi nhịp ngắn (để kiểm tra huỷ không phải đợi 1 việc chạy xong).
+
+    Khi bị huỷ (progress ném lỗi) thì bỏ các việc chưa chạy, không chờ các việc đang chạy.
+    """
+    try:
+        pending = set(futures)
+        while pending:
+            done = len(futures) - len(pending)
+            progress(done, len(futures), f"Xong {done}/{len(futures)} {unit} (song song)")
+            _, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+        progress(len(futures), len(futures), f"Xong {len(futures)} {unit}")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def build_prefix(file_name):
+    thang, nam = extract_month_year_from_filename(file_name)
+    return f"T{thang}_{nam}" if thang != "Tự đặt tên nhé" and nam != "Tự đặt tên nhé" else "TBD"
+
+def _process_file_job(file_name, file_bytes, chu_hau_to, prefix, store_path=None, archive_path=None, output_format="xlsx",
+                      sink=None, progress=None):
+    # Lỗi của 1 file được trả về chứ không làm hỏng cả lô.
+    # Trong tiến trình con (sink=None) kết quả được gom thành list (đường dẫn, bytes) để gửi về.
+    # Mỗi tiến trình tự mở kết nối tới kho tăng dần (store_path) của riêng nó; kho Parquet (archive_path) ghi thẳng từ tiến trình con.
+    buffer = BytesIO(file_bytes)
+    buffer.name = file_name
+    members = MemberListSink() if sink is None else sink
+    metrics = Metrics()
+    store = IncrementalStore(store_path) if store_path else None
+    archive = VoucherArchive(archive_path) if archive_path else None
+    try:
+        _, logs = process_single_file(
+            buffer, chu_hau_to, prefix, sink=members, metrics=metrics, store=store, progress=progress, archive=archive,
+            output_format=output_format,
+        )
+        return (members.members if sink is None else None), logs, None, metrics.records
+    except JobCancelled:
+        raise
+    except Exception:
+        return None, [], traceback.format_exc(), metrics.records
+    finally:
+        if store is not None:
+            store.close()
+
+def process_files(files, chu_hau_to, sink, max_workers=1, metrics=None, incremental_path=None, progress=None, archive_path=None,
+                  output_format="xlsx"):
+    """Xử lý danh sách (tên file, bytes) và ghi kết quả vào sink, mỗi file một thư mục.
+
+    Trả về [(file_name, logs, error)] theo đúng thứ tự upload.
+    max_workers <= 1 hoặc chỉ có 1 file → chạy tuần tự, ghi thẳng vào sink.
+    Số liệu đo của từng file (kể cả từ tiến trình con) được gộp vào metrics, kèm cột file.
+    incremental_path: đường dẫn kho IncrementalStore để chỉ xử lý lại các ngày thay đổi (None = xử lý lại toàn bộ).
+    progress(done, total, message): báo tiến độ theo file (chạy tuần tự thì theo cả từng sheet).
+    archive_path: đường dẫn kho VoucherArchive để lưu thêm các dòng chứng từ dạng Parquet (None = không lưu).
+    output_format: "xlsx" / "csv" / "parquet" (xem process_single_file).
+    """
+    progress = progress or (lambda *args: None)
+    jobs = [(name, data, chu_hau_to, build_prefix(name), incremental_path, archive_path, output_format) for name, data in files]
+    folders = [sink.with_prefix(f"{os.path.splitext(name)[0]}_{prefix}") for name, _, _, prefix, _, _, _ in jobs]
+    if max_workers > 1 and len(jobs) > 1:
+        pool = process_pool(min(max_workers, len(jobs)))
+        futures = [pool.submit(_process_file_job, *job) for job in jobs]
+        wait_with_progress(pool, futures, progress)
+        results = []
+        for folder, future in zip(folders, futures):
+            try:
+                members, logs, error, records = future.result()
+            except Exception:
+                members, logs, error, records = None, [], traceback.format_exc(), []
+            for path, data in members or []:
+                folder.writestr(path, data)
+            results.append((logs, error, records))
+    else:
+        results = []
+        for i, (job, folder) in enumerate(zip(jobs, folders)):
+            file_progress = lambda done, total, message, i=i, name=job[0]: progress(i + done / total, len(jobs), f"{name}: {message}")
+            results.append(_process_file_job(*job, sink=folder, progress=file_progress)[1:])
+        progress(len(jobs), len(jobs), f"Xong {len(jobs)} file")
+    if metrics is not None:
+        for job, (_, _, records) in zip(jobs, results):
+            metrics.extend(records, file=job[0])
+    return [(job[0], logs, error) for job, (logs, error, _) in zip(jobs, results)]
+
+
+# ====== ĐÁNH DẤU DÒNG TRÙNG (TAB 3) =======
+def mark_duplicates(df, keys=("Ngày", "Tên", "Số tiền")):
+    """Tính sẵn cờ "Lặp" (thay cho COUNTIFS) và mã nhóm trùng bằng hash của các cột khoá.
+
+    Trả về (cờ, mã nhóm): mã nhóm đánh số 1, 2, ... theo lần xuất hiện đầu, dòng không trùng để trống.
+    """
+    key_hash = pd.util.hash_pandas_object(df[list(keys)], index=False)
+    is_dup = key_hash.duplicated(keep=False)
+    flag = pd.Series(np.where(is_dup, "Lặp", ""), index=df.index)
+    group_id = pd.Series("", index=df.index, dtype=object)
+    group_id[is_dup] = pd.factorize(key_hash[is_dup])[0] + 1
+    return flag, group_id
+
+
+# ====== KHO KHOÁ FILE GỐC (TAB 2) =======
+BASE_STORE_PATH = os.environ.get("VOUCHER_BASE_STORE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "base_keys.sqlite"))
+
+class BaseKeyStore:
+    """Kho khoá (Tên chuẩn, Ngày chuẩn, Số tiền chuẩn) của File Gốc, lưu bằng SQLite và bổ sung dần theo tháng.
+
+    Bảng manifest ghi lại SHA-256 các file gốc đã nạp nên cùng 1 file không bị đọc lại lần 2.
+    """
+    def __init__(self, path=BASE_STORE_PATH):
+        self.path = path
+        self._con_pid = None
+        with self.con:
+            self.con.executescript("""
+                CREATE TABLE IF NOT EXISTS base_keys (
+                    ngay TEXT NOT NULL, ten TEXT NOT NULL, so_tien REAL NOT NULL,
+                    PRIMARY KEY (ngay, ten, so_tien)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS manifest (
+                    sha256 TEXT PRIMARY KEY, file_name TEXT, rows_added INTEGER, added_at TEXT
+                );
+            """)
+
+    def add_base_file(self, file_name, file_bytes, load_keys):
+        """Nạp 1 file gốc vào kho; load_keys() trả về DataFrame 3 cột khoá và chỉ được gọi khi file chưa có trong kho.
+
+        Trả về số khoá mới thêm, hoặc None nếu file đã được nạp trước đó.
+        """
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        if self.con.execute("SELECT 1 FROM manifest WHERE sha256 = ?", (digest,)).fetchone():
+            return None
+        keys = load_keys().dropna()
+        with self.con:
+            before = self.con.total_changes
+            self.con.executemany(
+                "INSERT OR IGNORE INTO base_keys (ten, ngay, so_tien) VALUES (?, ?, ?)",
+                keys.itertuples(index=False, name=None),
+            )
+            added = self.con.total_changes - before
+            self.con.execute(
+                "INSERT INTO manifest VALUES (?, ?, ?, ?)",
+                (digest, file_name, added, datetime.now().isoformat(timespec="seconds")),
+            )
+        return added
+
+    @property
+    def con(self):
+        # Mỗi tiến trình (kể cả tiến trình con khi xoá trùng song song) mở kết nối SQLite riêng
+        if self._con_pid != os.getpid():
+            self._con = sqlite3.connect(self.path, check_same_thread=False)
+            self._con_pid = os.getpid()
+        return self._con
+
+    def __getstate__(self):
+        return {"path": self.path, "_con_pid": None}
+
+    def lookup(self, dates):
+        """Lấy tập khoá (tên, ngày, số tiền) của các ngày cần so, dùng index theo ngày thay vì đọc cả kho."""
+        dates = [d for d in dict.fromkeys(dates) if d is not None]
+        keys = set()
+        for i in range(0, len(dates), 500):
+            chunk = dates[i:i + 500]
+            rows = self.con.execute(
+                f"SELECT ten, ngay, so_tien FROM base_keys WHERE ngay IN ({','.join('?' * len(chunk))})", chunk
+            )
+            keys.update(rows)
+        return keys
+
+    def stamp(self):
+        """Dấu thay đổi của kho (số file gốc đã nạp, tổng khoá thêm, lần nạp cuối), dùng làm khoá bộ nhớ đệm / job."""
+        return self.con.execute("SELECT COUNT(*), SUM(rows_added), MAX(added_at) FROM manifest").fetchone()
+
+    def sources(self):
+        return pd.read_sql_query(
+            "SELECT file_name AS 'File gốc', rows_added AS 'Số khoá thêm', added_at AS 'Thời điểm nạp' FROM manifest ORDER BY added_at",
+            self.con,
+        )
+
+
+# ====== SO SÁNH SỐ TIỀN GIỮA CÁC FILE (TAB 4) =======
+def parse_amounts(series):
+    """Đổi cột số tiền sang float: nhận số, "=VALUE(x)" và chuỗi có dấu phân cách hàng nghìn; giá trị hỏng thành NaN."""
+    amounts = pd.to_numeric(series, errors="coerce")
+    pending = amounts.isna() & series.notna()
+    if pending.any():
+        text = (
+            series[pending].astype(str)
+            .str.replace("=VALUE(", "", regex=False)
+            .str.replace(")", "", regex=False)
+            .str.replace(r"\s+", "", regex=True)
+        )
+        thousands = text.str.fullmatch(r"-?\d{1,3}([.,]\d{3})+")
+        text = text.where(~thousands, text.str.replace(r"[.,]", "", regex=True))
+        amounts[pending] = pd.to_numeric(text, errors="coerce")
+    return amounts.astype(float)
+
+def compare_amounts(records, file_order):
+    """So sánh số tiền theo KEY trên bảng dạng dài (KEY, TÊN FILE, TÊN SHEET, SỐ TIỀN GỐC).
+
+    Trả về (số KEY có dữ liệu, bảng ngang các KEY lệch, bảng chi tiết file lệch so với giá trị tham chiếu).
+    Giá trị tham chiếu của 1 KEY là số tiền xuất hiện ở nhiều file nhất (hoà thì lấy file tải lên trước).
+    """
+    records = records.assign(
+        KEY=records["KEY"].astype("category"),
+        **{
+            "TÊN FILE": pd.Categorical(records["TÊN FILE"], categories=list(dict.fromkeys(file_order))),
+            "TÊN SHEET": records["TÊN SHEET"].astype("category"),
+        },
+    )
+    # Giống pivot_table(aggfunc="first"): giá trị khác rỗng đầu tiên của mỗi (KEY, file)
+    firsts = (
+        records.groupby(["KEY", "TÊN FILE"], observed=True, sort=False)["SỐ TIỀN GỐC"]
+        .first().dropna().reset_index()
+    )
+    spread = firsts.groupby("KEY", observed=True)["SỐ TIỀN GỐC"].agg(["min", "max"])
+    diff_keys = spread.index[spread["max"] > spread["min"]]
+    diff = firsts[firsts["KEY"].isin(diff_keys)]
+
+    wide = diff.pivot(index="KEY", columns="TÊN FILE", values="SỐ TIỀN GỐC")
+    wide = wide.dropna(axis=1, how="all").sort_index().reset_index()
+    wide["KEY"] = wide["KEY"].astype(str)
+    wide.columns = [str(c) for c in wide.columns]
+
+    diff = diff.assign(THU_TU=diff["TÊN FILE"].cat.codes)
+    votes = (
+        diff.groupby(["KEY", "SỐ TIỀN GỐC"], observed=True)["THU_TU"].agg(["size", "min"]).reset_index()
+        .sort_values(["KEY", "size", "min"], ascending=[True, False, True])
+        .drop_duplicates("KEY")
+        .set_index("KEY")["SỐ TIỀN GỐC"]
+    )
+    diff = diff.assign(**{"Số tiền tham chiếu": diff["KEY"].map(votes).astype(float)})
+    details = diff[diff["SỐ TIỀN GỐC"] != diff["Số tiền tham chiếu"]]
+    details = pd.DataFrame({
+        "KEY": details["KEY"].astype(str),
+        "File lệch": details["TÊN FILE"].astype(str),
+        "Số tiền": details["SỐ TIỀN GỐC"],
+        "Số tiền tham chiếu": details["Số tiền tham chiếu"],
+        "Chênh lệch": details["SỐ TIỀN GỐC"] - details["Số tiền tham chiếu"],
+    }).sort_values(["KEY", "File lệch"]).reset_index(drop=True)
+    return firsts["KEY"].nunique(), wide, details
+
+
+# ====== ĐỐI CHIẾU MISA / EXCEL (TAB 5) =======
+def read_pasted_table(text):
+    """Đọc bảng dán (phân tách bằng tab) bằng 1 lần read_csv thành bảng ô dạng chuỗi.
+
+    Khoảng trắng đầu dòng bị bỏ như khi strip từng dòng; dòng trống bị bỏ qua.
+    """
+    text = re.sub(r"(?m)^[ \t]+", "", text.replace("\r\n", "\n").replace("\r", "\n"))
+    lines = text.split("\n")
+    width = max(map(str.count, lines, itertools.repeat("\t", len(lines))), default=0) + 1
+    if not text.strip():
+        return pd.DataFrame(columns=range(width), dtype=object)
+    return pd.read_csv(
+        StringIO(text), sep="\t", header=None, names=range(width), dtype=str,
+        quoting=csv.QUOTE_NONE, na_filter=False, skip_blank_lines=True, engine="c",
+    ).fillna("")
+
+def map_unique(series, func):
+    """Chạy func (nhận/trả Series) trên các giá trị khác nhau của cột rồi trải kết quả về đủ số dòng."""
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    result = func(pd.Series(uniques, dtype=object)).to_numpy()
+    return pd.Series(result[codes], index=series.index)
+
+def parse_vn_number(series, thousands=".", decimal=","):
+    """Đổi chuỗi số kiểu Việt Nam (1.200.000,5) sang float; ô không phải số thành NaN."""
+    def convert(values):
+        values = values.str.replace(thousands, "", regex=False)
+        if decimal:
+            values = values.str.replace(decimal, ".", regex=False)
+        return pd.to_numeric(values.str.strip(), errors="coerce")
+    return map_unique(series, convert).astype(float)
+
+def parse_misa(text):
+    """Bảng công nợ MISA → (Mã Y Tế, Phát sinh): dòng mã y tế được ffill xuống các dòng ngày bên dưới."""
+    cells = read_pasted_table(text)
+    if 10 not in cells.columns:
+        return pd.DataFrame({"Mã Y Tế": pd.Series(dtype=object), "Phát sinh": pd.Series(dtype=float)})
+    # Cột đầu của dòng ngày chỉ có vài chục giá trị khác nhau nên regex chạy trên giá trị duy nhất
+    is_ma = map_unique(cells[0], lambda v: v.str.match(r'^[A-Z0-9]{6,}')).astype(bool)
+    is_ngay = ~is_ma & map_unique(cells[0], lambda v: v.str.match(r'^\d{2}/\d{2}/\d{4}')).astype(bool)
+    # Dòng mã y tế lấy cả dòng (các ô nối lại bằng tab, bỏ ô trống cuối dòng)
+    ma_rows = cells[is_ma].astype(object)
+    ma_line = ma_rows[0].str.cat([ma_rows[c] for c in ma_rows.columns[1:]], sep="\t").str.rstrip()
+    # astype(str): cùng kiểu cột chuỗi mặc định với "Mã Y Tế" của parse_excel (để ghép 2 bảng ở Tab 5)
+    ma = ma_line.reindex(cells.index).ffill().fillna("").astype(str)
+    phat_sinh = parse_vn_number(cells[10])
+    keep = is_ngay & phat_sinh.notna()
+    return pd.DataFrame({"Mã Y Tế": ma[keep], "Phát sinh": phat_sinh[keep]}).reset_index(drop=True)
+
+def parse_excel(text):
+    """Bảng thu tiền Excel → (Mã Y Tế, Họ tên, Đã thu) từ các cột 5, 6, 7."""
+    cells = read_pasted_table(text)
+    if 6 not in cells.columns:
+        return pd.DataFrame({"Mã Y Tế": pd.Series(dtype=object), "Họ tên": pd.Series(dtype=object), "Đã thu": pd.Series(dtype=float)})
+    da_thu = parse_vn_number(cells[6], thousands=",", decimal=None)
+    keep = da_thu.notna()
+    return pd.DataFrame({
+        "Mã Y Tế": cells.loc[keep, 5].str.strip().str.replace(".", "", regex=False),
+        "Họ tên": cells.loc[keep, 4].str.strip().str.upper(),
+        "Đã thu": da_thu[keep],
+    }).reset_index(drop=True)
+
+
+# ====== XOÁ DÒNG TRÙNG VỚI FILE GỐC (TAB 2) =======
+def normalize_name(name):
+    return re.sub(r'\s+', ' ', str(name).strip().lower())
+
+def fold_accents(name):
+    """Bỏ dấu tiếng Việt (kể cả đ → d) để "nguyen van a" khớp với "nguyễn văn a"."""
+    text = unicodedata.normalize("NFD", str(name)).replace("đ", "d").replace("Đ", "D")
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def pick_name_similarity():
+    # rapidfuzz (nếu đã cài) tính nhanh hơn nhiều; không có thì dùng difflib của thư viện chuẩn (cùng thang 0 → 1)
+    try:
+        from rapidfuzz.fuzz import ratio
+        return lambda a, b: ratio(a, b) / 100
+    except ImportError:
+        return lambda a, b: SequenceMatcher(None, a, b).ratio()
+
+name_similarity = pick_name_similarity()
+
+def name_blocks(base_keys):
+    """Chia khoá gốc thành khối theo (Ngày chuẩn, Số tiền chuẩn): {(ngày, tiền): [(tên bỏ dấu, tên gốc)]}."""
+    blocks = {}
+    for ten, ngay, so_tien in base_keys:
+        blocks.setdefault((ngay, so_tien), []).append((fold_accents(ten), ten))
+    return blocks
+
+def fuzzy_base_matches(df, blocks, threshold):
+    """Các dòng của df gần trùng tên với 1 khoá gốc cùng ngày + số tiền (điểm giống nhau >= threshold).
+
+    Mỗi dòng chỉ so với các tên cùng khối nên chi phí gần tuyến tính theo số dòng, không phải so từng cặp.
+    Trả về list (index dòng, tên dòng, tên gốc, điểm).
+    """
+    matches = []
+    for idx, ten, ngay, so_tien in zip(df.index, df["Tên chuẩn"], df["Ngày chuẩn"], df["Số tiền chuẩn"]):
+        candidates = blocks.get((ngay, so_tien))
+        if not candidates:
+            continue
+        folded = fold_accents(ten)
+        score, base_name = max((name_similarity(folded, base_folded), base_name) for base_folded, base_name in candidates)
+        if score >= threshold:
+            matches.append((idx, ten, base_name, score))
+    return matches
+
+# Số cặp gần trùng tối đa ghi vào nhật ký cho mỗi sheet
+FUZZY_LOG_PAIRS = 100
+
+def normalize_date(date_val):
+    try:
+        d = pd.to_datetime(date_val, dayfirst=True, errors="coerce")
+        return d.strftime("%d/%m/%Y") if pd.notnull(d) else None
+    except:
+        return None
+
+def normalize_columns(columns):
+    return [
+        str(c).strip()
+        .replace('\xa0', ' ')
+        .replace('\n', ' ')
+        .replace('\t', ' ')
+        .replace('\r', ' ')
+        .strip()
+        for c in columns
+    ]
+
+def extract_type_from_path(path):
+    path = path.upper()
+    if "KCB" in path: return "KCB"
+    elif "THUOC" in path: return "THUOC"
+    elif "VACCINE" in path: return "VACCINE"
+    elif "THE" in path: return "THE"
+    return "KHAC"
+
+def format_sct(row, chu_hau_to="DA"):
+    try:
+        d = pd.to_datetime(row["Ngày chứng từ (*)"], dayfirst=True)
+        date_str = d.strftime("%d%m%y")
+        month = d.strftime("%m")
+        is_pt = "THU" in str(row.get("Diễn giải", "")).upper()
+        mode = "PT" if is_pt else "PC"
+        return f"NVK/{mode}{month}_{date_str}_{chu_hau_to}"
+    except:
+        return f"NVK/PT??_TBD_{chu_hau_to}"
+
+def _sct_date_part(date_val):
+    try:
+        d = pd.to_datetime(date_val, dayfirst=True)
+        return f"{d.strftime('%m')}_{d.strftime('%d%m%y')}"
+    except:
+        return None
+
+def format_sct_column(df, chu_hau_to="DA"):
+    """Phiên bản theo cột của format_sct: mỗi ngày khác nhau chỉ parse 1 lần, PT/PC xét bằng str.contains."""
+    date_part = format_date_column(df["Ngày chứng từ (*)"], _sct_date_part)
+    dien_giai = df["Diễn giải"] if "Diễn giải" in df.columns else pd.Series("", index=df.index)
+    mode = pd.Series(np.where(dien_giai.map(str).str.upper().str.contains("THU", regex=False), "PT", "PC"), index=df.index, dtype=object)
+    sct = "NVK/" + mode + date_part + f"_{chu_hau_to}"
+    return sct.where(date_part.notna(), f"NVK/PT??_TBD_{chu_hau_to}")
+
+def load_base_keys(base_file, metrics=None):
+    """Đọc File Gốc và trả về bảng khoá (Tên chuẩn, Ngày chuẩn, Số tiền chuẩn)."""
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.stage("Đọc File Gốc") as record:
+        base_reader = ExcelReader(base_file)
+        base_df = base_reader.read(
+            base_reader.sheet_names[0], ["Tên đối tượng", "Ngày hạch toán (*)", "Số tiền"],
+            normalize=lambda c: normalize_columns([c])[0],
+        )
+        base_df.columns = normalize_columns(base_df.columns)
+        record["rows"] = len(base_df)
+    with metrics.stage("Chuẩn hoá khoá gốc", rows=len(base_df)):
+        return pd.DataFrame({
+            "Tên chuẩn": base_df["Tên đối tượng"].apply(normalize_name),
+            "Ngày chuẩn": format_date_column(base_df["Ngày hạch toán (*)"], normalize_date),
+            "Số tiền chuẩn": pd.to_numeric(base_df["Số tiền"], errors='coerce'),
+        })
+
+class FixedBaseKeys:
+    """Hàm tra khoá gốc trả về cùng 1 tập khoá cho mọi ngày (File Gốc), cùng dạng BaseKeyStore.lookup.
+
+    Gửi được (pickle) sang tiến trình con xoá trùng song song; khối tên (name_blocks) chia 1 lần rồi gửi kèm.
+    """
+    def __init__(self, base_keys):
+        self.base_keys = base_keys
+        self.blocks = None
+
+    def __call__(self, dates):
+        return self.base_keys
+
+    def name_blocks(self):
+        if self.blocks is None:
+            self.blocks = name_blocks(self.base_keys)
+        return self.blocks
+
+def base_keys_lookup(base_keys_df):
+    """Biến bảng khoá File Gốc thành hàm tra cứu cùng dạng BaseKeyStore.lookup."""
+    return FixedBaseKeys(frozenset(zip(base_keys_df["Tên chuẩn"], base_keys_df["Ngày chuẩn"], base_keys_df["Số tiền chuẩn"])))
+
+dedup_keep_cols = [
+    "Ngày hạch toán (*)", "Ngày chứng từ (*)", "Số chứng từ (*)",
+    "Mã đối tượng có", "Mã đối tượng nợ", "Diễn giải",
+    "Tên đối tượng", "Diễn giải (hạch toán)", "TK Nợ (*)",
+    "TK Có (*)", "Số tiền"
+]
+
+# Hàm tra khoá gốc của tiến trình con xoá trùng (gán 1 lần khi tạo tiến trình, dùng chung cho mọi file)
+_worker_base_keys = None
+
+def _init_dedup_worker(get_base_keys):
+    global _worker_base_keys
+    _worker_base_keys = get_base_keys
+
+def _dedup_member(file_name, data, chu_hau_to, get_base_keys=None, fuzzy_threshold=None):
+    """Xoá trùng 1 file xlsx trong ZIP: đọc mọi sheet 1 lần, trả về (tên file mới, bytes, logs, số dòng xoá, số liệu đo).
+
+    fuzzy_threshold (0 → 1): xoá thêm các dòng cùng ngày + số tiền có tên gần giống tên gốc (sai chính tả, thiếu dấu).
+    """
+    get_base_keys = get_base_keys or _worker_base_keys
+    metrics = Metrics()
+    logs = []
+    total_removed = 0
+    with metrics.stage("Đọc file", file_name) as record:
+        reader = ExcelReader(BytesIO(data))
+        sheets = reader.read_all()
+        record["rows"] = sum(len(df) for df in sheets.values())
+    output = BytesIO()
+
+    with StreamingWorkbook(output) as workbook:
+        for sheet, df in sheets.items():
+            df.columns = normalize_columns(df.columns)
+
+            if not set(["Tên đối tượng", "Ngày hạch toán (*)", "Số tiền"]).issubset(df.columns):
+                continue
+
+            with metrics.stage("Xoá trùng + số chứng từ", f"{file_name} | {sheet}", len(df)):
+                df["Tên chuẩn"] = df["Tên đối tượng"].apply(normalize_name)
+                df["Ngày chuẩn"] = format_date_column(df["Ngày hạch toán (*)"], normalize_date)
+                df["Số tiền chuẩn"] = pd.to_numeric(df["Số tiền"], errors='coerce')
+
+                before = len(df)
+                sheet_base_keys = get_base_keys(df["Ngày chuẩn"].unique())
+                df = df[~df.set_index(["Tên chuẩn", "Ngày chuẩn", "Số tiền chuẩn"]).index.isin(sheet_base_keys)]
+                matches = []
+                if fuzzy_threshold is not None and len(df):
+                    # File Gốc: khối tên chia sẵn 1 lần cho cả ZIP; kho (tra theo ngày): chỉ chia các khoá của ngày trong sheet
+                    if isinstance(get_base_keys, FixedBaseKeys):
+                        blocks = get_base_keys.name_blocks()
+                    else:
+                        blocks = name_blocks(sheet_base_keys)
+                    matches = fuzzy_base_matches(df, blocks, fuzzy_threshold)
+                    df = df.drop(index=[idx for idx, _, _, _ in matches])
+                removed = before - len(df)
+                total_removed += removed
+                logs.append(f"- {file_name} | {sheet}: ❌ Đã xoá {removed} dòng")
+                if matches:
+                    logs.append(f"  - 🔎 Trong đó {len(matches)} dòng gần trùng tên (ngưỡng {fuzzy_threshold:.2f}):")
+                    logs.extend(f"    - {ten} ≈ {base_name} ({score:.2f})" for _, ten, base_name, score in matches[:FUZZY_LOG_PAIRS])
+                    if len(matches) > FUZZY_LOG_PAIRS:
+                        logs.append(f"    - … và {len(matches) - FUZZY_LOG_PAIRS} cặp khác")
+
+                # Đổi cột Diễn giải lý do thu → Diễn giải
+                if "Diễn giải lý do thu" in df.columns:
+                    df.rename(columns={"Diễn giải lý do thu": "Diễn giải"}, inplace=True)
+
+                # Gán số chứng từ mới
+                df["Số chứng từ (*)"] = format_sct_column(df, chu_hau_to)
+
+                # Chỉ giữ cột cần
+                df = df[[c for c in dedup_keep_cols if c in df.columns]]
+
+                # Sửa tên cột "Tên đối tượng" → "họ tên"
+                df.rename(columns={"Tên đối tượng": "họ tên"}, inplace=True)
+
+            with metrics.stage("Ghi xlsx", f"{file_name} | {sheet}", len(df)):
+                workbook.write_frame(sheet, df)
+
+    mode = "PT" if "PT" in file_name.upper() else "PC"
+    loai = extract_type_from_path(file_name)
+    return f"{mode}_{loai}.xlsx", output.getvalue(), logs, total_removed, metrics.records
+
+def remove_duplicates_from_zip(zip_file, get_base_keys, chu_hau_to="DA", metrics=None, progress=None, max_workers=1, fuzzy_threshold=None):
+    """Xoá khỏi ZIP đầu ra các dòng đã có trong File Gốc (theo Tên + Ngày + Số tiền) và gán lại số chứng từ.
+
+    get_base_keys(dates) trả về tập khoá gốc của các ngày cần so.
+    Trả về (BytesIO chứa zip mới, logs, tổng số dòng đã xoá).
+    progress(done, total, message): báo tiến độ theo file trong ZIP.
+    max_workers > 1: các file trong ZIP được xoá trùng song song ở tiến trình con, kết quả ghép lại đúng thứ tự cũ.
+    fuzzy_threshold: bật xoá cả dòng gần trùng tên (xem _dedup_member); None = chỉ xoá dòng trùng khớp.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    progress = progress or (lambda *args: None)
+    with zipfile.ZipFile(zip_file, 'r') as zin:
+        members = [(name, zin.read(name)) for name in zin.namelist() if name.endswith(".xlsx")]
+        skipped = [name for name in zin.namelist() if name.endswith((".csv", ".parquet"))]
+
+    if fuzzy_threshold is not None and isinstance(get_base_keys, FixedBaseKeys):
+        with metrics.stage("Chia khối tên gốc", rows=len(get_base_keys.base_keys)):
+            get_base_keys.name_blocks()  # trước khi tạo tiến trình con: khối tên gửi kèm, không tiến trình nào phải chia lại
+
+    if max_workers > 1 and len(members) > 1:
+        pool = process_pool(min(max_workers, len(members)), _init_dedup_worker, (get_base_keys,))
+        futures = [pool.submit(_dedup_member, name, data, chu_hau_to, None, fuzzy_threshold) for name, data in members]
+        wait_with_progress(pool, futures, progress)
+        results = [future.result() for future in futures]
+    else:
+        results = []
+        for i, (name, data) in enumerate(members):
+            progress(i, len(members), name)
+            results.append(_dedup_member(name, data, chu_hau_to, get_base_keys, fuzzy_threshold))
+        progress(len(members), len(members), f"Xong {len(members)} file")
+
+    logs = []
+    if skipped:
+        logs.append(f"⚠️ Bỏ qua {len(skipped)} file csv / parquet: chỉ xoá trùng được file xlsx (tạo lại ở Tab 1 với định dạng xlsx)")
+    total_removed = 0
+    output_zip = BytesIO()
+    with zipfile.ZipFile(output_zip, "w") as zout:
+        for out_name, data, member_logs, removed, records in results:
+            zout.writestr(out_name, data)
+            logs.extend(member_logs)
+            total_removed += removed
+            metrics.extend(records)
+
+    output_zip.seek(0)
+    return output_zip, logs, total_removed
+
+
+# ====== GỘP DỮ LIỆU THÁNG (TAB 3) =======
+def month_label_from_zip_name(zip_name):
+    # 🧠 Lấy tên tháng & năm từ file zip nếu có thể
+    match = re.search(r't(\d{1,2})[_\-\.](\d{4})', zip_name.lower())
+    if match:
+        return f"T{int(match.group(1))}", match.group(2)
+    return "TBD", "XXXX"
+
+def month_of(*names):
+    """(năm, tháng) lấy từ tên đầu tiên có dạng T<tháng>_<năm> (đường dẫn file trong zip, tên zip...); không thấy thì None."""
+    for name in names:
+        match = re.search(r't(\d{1,2})[_\-\.](\d{4})', str(name).lower())
+        if match:
+            return int(match.group(2)), int(match.group(1))
+    return None
+
+def period_label(month, period="month"):
+    """Nhãn kỳ gộp của 1 tháng: month → T7_2024, quarter → Q3_2024, year → 2024, None → TatCa."""
+    if period is None:
+        return "TatCa"
+    if month is None:
+        return "TBD"
+    year, m = month
+    return {"month": f"T{m}_{year}", "quarter": f"Q{(m - 1) // 3 + 1}_{year}", "year": f"{year}"}[period]
+
+def compact_text(series):
+    # pandas 3 đọc chuỗi thành kiểu str (Arrow) vốn đã gọn, category còn tốn hơn; cột object (pandas 2, ô lẫn kiểu) mới đổi sang category
+    return series if isinstance(series.dtype, pd.StringDtype) else series.astype("category")
+
+def compact_amounts(series):
+    # Số tiền nguyên, không ô trống → int64; còn lại giữ nguyên kiểu khi đọc
+    if series.dtype.kind == "f" and series.notna().all() and (series % 1 == 0).all():
+        return series.astype(np.int64)
+    return series
+
+def concat_column(parts):
+    """Nối 1 cột của các sheet; toàn category thì ghép danh mục (giữ kiểu gọn), khác kiểu thì để pandas tự chọn kiểu chung."""
+    if all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+        try:
+            return pd.Series(pd.api.types.union_categoricals(parts, ignore_order=True))
+        except TypeError:
+            pass  # danh mục khác kiểu (VD: ngày dạng chuỗi ở sheet này, dạng ngày ở sheet kia)
+    return pd.concat(parts, ignore_index=True)
+
+class GroupAccumulator:
+    """Gom dần 3 cột cần của các sheet thuộc 1 nhóm (VD: PT_KCB) trong 1 kỳ, kèm cột Tháng dạng category.
+
+    Mỗi sheet chỉ giữ lại bản gọn (chữ: str / category, Số tiền: int64) ngay khi đọc xong; cả kỳ chỉ nối 1 lần lúc ghi.
+    """
+    def __init__(self):
+        self.parts = []
+        self.rows = 0
+
+    def add(self, df, month):
+        thang = f"{month[1]:02d}/{month[0]}" if month else "TBD"
+        self.parts.append({
+            "Ngày": compact_text(df["Ngày chứng từ (*)"]),
+            "Tên": compact_text(df["Tên đối tượng"]),
+            "Số tiền": compact_amounts(df["Số tiền"]),
+            "Tháng": pd.Series(pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), [thang])),
+        })
+        self.rows += len(df)
+
+    def frame(self):
+        return pd.DataFrame({col: concat_column([p[col] for p in self.parts]) for col in ["Ngày", "Tên", "Số tiền", "Tháng"]})
+
+consolidate_groups = ["PT_KCB", "PC_KCB", "PT_THUOC", "PC_THUOC", "PT_VACCINE", "PC_VACCINE"]
+
+def member_sheets(zipf, filename, columns, metrics, label):
+    """Các sheet PT/PC (tên "<PT|PC><ngày>", bảng chỉ gồm các cột columns) của 1 file trong ZIP đầu ra Tab 1.
+
+    xlsx: sheet PT<ngày> / PC<ngày>, hoặc file <PT|PC>.xlsx của Tab 1 với sheet là số ngày;
+    csv / parquet (.../<PT|PC>/<ngày>.csv): cả file là 1 sheet.
+    """
+    parts = filename.split("/")
+    if filename.endswith(".xlsx"):
+        file_mode = os.path.splitext(parts[-1])[0].upper()
+        with zipf.open(filename) as f:
+            reader = ExcelReader(f)
+            for sheet_name in reader.sheet_names:
+                if sheet_name.startswith("PT") or sheet_name.startswith("PC"):
+                    name = sheet_name
+                elif file_mode in ("PT", "PC") and is_day_sheet(sheet_name):
+                    name = file_mode + sheet_name
+                else:
+                    continue
+                with metrics.stage("Đọc sheet", f"{label} | {sheet_name}") as record:
+                    df = reader.read(sheet_name, columns)
+                    record["rows"] = len(df)
+                yield name, df
+        return
+    if len(parts) < 2 or parts[-2] not in ("PT", "PC"):
+        return
+    sheet_name = parts[-2] + os.path.splitext(parts[-1])[0]
+    with metrics.stage("Đọc sheet", f"{label} | {sheet_name}") as record:
+        with zipf.open(filename) as f:
+            if filename.endswith(".csv"):
+                # Giữ nguyên chữ (tên "Nan", "Na"... không bị đọc thành ô trống), chỉ ô rỗng mới là trống
+                df = pd.read_csv(
+                    f, encoding="utf-8-sig", usecols=lambda c: c in columns, keep_default_na=False,
+                    dtype={"Ngày chứng từ (*)": str, "Tên đối tượng": str}, na_values={"Ngày chứng từ (*)": [""], "Số tiền": [""]},
+                )
+            else:
+                df = pd.read_parquet(BytesIO(f.read()))
+                df = df[[c for c in columns if c in df.columns]]
+        record["rows"] = len(df)
+    yield sheet_name, df
+
+def consolidate_zips(zip_files, period="month", use_formula=False, add_group=False, metrics=None):
+    """Gộp các sheet PT/PC trong nhiều ZIP đầu ra Tab 1 thành 1 workbook mỗi kỳ (mỗi nhóm 1 sheet, có cột Tháng).
+
+    zip_files: list (tên zip, file); tháng của mỗi file lấy từ đường dẫn trong zip, không có thì từ tên zip.
+    period: "month" / "quarter" / "year", hoặc None = gộp tất cả vào 1 workbook.
+    Cờ "Lặp" được tính 1 lần trên toàn kỳ sau khi đã đọc hết. Trả về {nhãn kỳ: bytes}, sắp theo thời gian;
+    kỳ không có sheet PT/PC nào thì không có workbook (không có dữ liệu → dict rỗng).
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    # {nhãn kỳ: ((năm, tháng) để sắp xếp, {nhóm: GroupAccumulator})}; kỳ chỉ được tạo khi có sheet đọc được
+    periods = {}
+
+    for zip_name, zip_file in zip_files:
+        with zipfile.ZipFile(zip_file, "r") as zipf:
+            for filename in zipf.namelist():
+                if not filename.endswith((".xlsx", ".csv", ".parquet")):
+                    continue
+
+                short_type = None
+                if "KCB" in filename.upper():
+                    short_type = "KCB"
+                elif "THUOC" in filename.upper():
+                    short_type = "THUOC"
+                elif "VACCINE" in filename.upper():
+                    short_type = "VACCINE"
+                else:
+                    continue
+                month = month_of(filename, zip_name)
+
+                columns = ["Ngày chứng từ (*)", "Tên đối tượng", "Số tiền"]
+                for sheet_name, df in member_sheets(zipf, filename, columns, metrics, f"{zip_name} | {filename}"):
+                    if not set(columns).issubset(df.columns):
+                        continue
+
+                    mode = "PT" if sheet_name.startswith("PT") else "PC"
+                    key = f"{mode}_{short_type}"
+                    groups = periods.setdefault(period_label(month, period), ((month or (9999, 99)), {}))[1]
+                    groups.setdefault(key, GroupAccumulator()).add(df, month)
+
+    books = {}
+    for label, (_, groups) in sorted(periods.items(), key=lambda item: item[1][0]):
+        output = BytesIO()
+        n_rows = sum(acc.rows for acc in groups.values())
+        with StreamingWorkbook(output, constant_memory=n_rows >= STREAMING_MIN_ROWS) as workbook:
+            for key in consolidate_groups:
+                if key not in groups:
+                    continue
+                with metrics.stage("Đánh dấu trùng", f"{label} | {key}", groups[key].rows):
+                    merged_df = groups[key].frame()
+                    thang = merged_df.pop("Tháng")
+
+                    # Cột Ghi chú: để trống rồi viết công thức, hoặc tính sẵn cờ "Lặp"
+                    if use_formula:
+                        merged_df["Ghi chú"] = ""
+                    else:
+                        merged_df["Ghi chú"], nhom_trung = mark_duplicates(merged_df)
+                        if add_group:
+                            merged_df["Nhóm trùng"] = nhom_trung
+                    # Cột Tháng để cuối: công thức COUNTIFS vẫn so các cột A:C
+                    merged_df["Tháng"] = thang
+
+                with metrics.stage("Ghi xlsx", f"{label} | {key}", len(merged_df)):
+                    widths = column_widths(merged_df)
+
+                    # Viết công thức Ghi chú (độ rộng cột đã tính theo ô trống); ghi cùng lượt với dữ liệu
+                    if use_formula:
+                        row_no = pd.Series(np.arange(2, len(merged_df) + 2), dtype=str)
+                        merged_df["Ghi chú"] = '=IF(COUNTIFS(A:A,A' + row_no + ',B:B,B' + row_no + ',C:C,C' + row_no + ')>1,"Lặp","")'
+
+                    workbook.write_frame(
+                        key, merged_df, header={'bold': True, 'bg_color': '#FCE4D6', 'border': 1},
+                        widths=widths, tab_color="#FFD966",
+                    )
+        books[label] = output.getvalue()
+
+    return books
+
+def consolidate_zip(zip_file, use_formula=False, add_group=False, metrics=None):
+    """Gộp 1 ZIP đầu ra Tab 1 thành 1 workbook tổng hợp (mỗi nhóm 1 sheet); trả về bytes (workbook trống nếu không có dữ liệu)."""
+    books = consolidate_zips(
+        [(getattr(zip_file, "name", ""), zip_file)], period=None,
+        use_formula=use_formula, add_group=add_group, metrics=metrics,
+    )
+    if "TatCa" not in books:
+        output = BytesIO()
+        StreamingWorkbook(output).close()
+        return output.getvalue()
+    return books["TatCa"]
+
+
+# ====== SO SÁNH NHIỀU FILE (TAB 4) =======
+def collect_amount_records(files, metrics=None):
+    """Đọc (tên file, file) → bảng dạng dài (KEY, TÊN, SỐ CHỨNG TỪ, SỐ TIỀN GỐC, TÊN FILE, TÊN SHEET); None nếu không có sheet phù hợp."""
+    metrics = metrics if metrics is not None else Metrics()
+    all_records = []
+
+    for file_name, file in files:
+        reader = ExcelReader(file)
+        for sheet in reader.sheet_names:
+            with metrics.stage("Đọc sheet", f"{file_name} | {sheet}") as record:
+                df = reader.read(
+                    sheet, ["số tiền", "số chứng từ (*)", "ngày chứng từ (*)", "họ và tên", "tên đối tượng"],
+                    normalize=lambda c: str(c).strip().lower(),
+                )
+                record["rows"] = len(df)
+            df.columns = [str(c).strip() for c in df.columns]
+
+            cols_lower = [c.lower() for c in df.columns]
+            required = {"số tiền", "số chứng từ (*)", "ngày chứng từ (*)"}
+            if not required.issubset(set(cols_lower)):
+                continue
+
+            ten_col = next((c for c in df.columns if c.strip().lower() in ["họ và tên", "tên đối tượng"]), None)
+            if not ten_col: continue
+
+            df["TÊN FILE"] = file_name
+            df["TÊN SHEET"] = sheet
+            df["TÊN"] = df[ten_col].astype(str).str.strip()
+            df["SỐ CHỨNG TỪ"] = df["Số chứng từ (*)"].astype(str)
+            df["KEY"] = df["TÊN"] + "_" + df["SỐ CHỨNG TỪ"]
+
+            df["SỐ TIỀN GỐC"] = parse_amounts(df["Số tiền"])
+
+            all_records.append(df[["KEY", "TÊN", "SỐ CHỨNG TỪ", "SỐ TIỀN GỐC", "TÊN FILE", "TÊN SHEET"]])
+
+    if not all_records:
+        return None
+    return pd.concat(all_records, ignore_index=True)
+
+def comparison_workbook(result_df, chi_tiet_df):
+    excel_bytes = BytesIO()
+    with StreamingWorkbook(excel_bytes, constant_memory=len(result_df) + len(chi_tiet_df) >= STREAMING_MIN_ROWS) as workbook:
+        workbook.write_frame("Khác biệt", result_df, fit_columns=False)
+        workbook.write_frame("Chi tiết chênh lệch", chi_tiet_df, fit_columns=False)
+    return excel_bytes.getvalue()
+
+
+# ====== SO KHỚP CÔNG NỢ (TAB 5) =======
+def reconcile_misa_excel(misa_text, excel_text, metrics=None):
+    """Ghép phát sinh MISA với số đã thu theo Mã Y Tế và tính Chênh lệch = Đã thu - Phát sinh."""
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.stage("Đọc bảng MISA") as record:
+        df_misa = parse_misa(misa_text)
+        record["rows"] = len(df_misa)
+    with metrics.stage("Đọc bảng Excel") as record:
+        df_excel = parse_excel(excel_text)
+        record["rows"] = len(df_excel)
+
+    with metrics.stage("Ghép + chênh lệch", rows=len(df_misa) + len(df_excel)):
+        df = pd.merge(df_misa, df_excel, on="Mã Y Tế", how="outer")
+        df["Phát sinh"] = df["Phát sinh"].fillna(0)
+        df["Đã thu"] = df["Đã thu"].fillna(0)
+        df["Chênh lệch"] = df["Đã thu"] - df["Phát sinh"]
+    return df
+
+
+# ====== DÒNG LỆNH =======
+def consolidate_folder(input_dir, output_dir, period):
+    """Phần --consolidate của CLI: gộp mọi file .zip trong input_dir, in 1 dòng JSON mỗi file tổng hợp và 1 dòng tổng kết."""
+    names = sorted(n for n in os.listdir(input_dir) if n.lower().endswith(".zip"))
+    if not names:
+        print(json.dumps({"event": "error", "error": f"Không có file .zip trong {input_dir}"}, ensure_ascii=False))
+        return 2
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    metrics = Metrics()
+    books = consolidate_zips([(name, os.path.join(input_dir, name)) for name in names], period=period, metrics=metrics)
+    for label, data in books.items():
+        path = os.path.join(output_dir, f"TongHop_{label}.xlsx")
+        with open(path, "wb") as out:
+            out.write(data)
+        print(json.dumps({"event": "workbook", "period": label, "output": path}, ensure_ascii=False))
+    metrics_path = os.path.join(output_dir, "TongHop.metrics.json")
+    with open(metrics_path, "w", encoding="utf-8") as out:
+        out.write(metrics.to_json())
+    print(json.dumps({
+        "event": "summary", "zips": len(names), "workbooks": len(books),
+        "metrics": metrics_path, "seconds": round(time.perf_counter() - start, 3),
+    }, ensure_ascii=False))
+    return 0
+
+def main(argv=None):
+    """Xử lý cả thư mục file Excel tháng thành 1 zip tổng hợp (giống nút "Tạo File Zip Tổng Hợp" ở Tab 1).
+
+    Mỗi file in ra 1 dòng JSON trên stdout, cuối cùng là 1 dòng tổng kết.
+    Số liệu đo từng bước được ghi cạnh file zip (<tên zip>.metrics.json).
+    Mã thoát: 0 = thành công, 1 = có file lỗi, 2 = tham số sai / không có file đầu vào.
+    """
+    parser = argparse.ArgumentParser(description="Tạo file hạch toán từ thư mục file Excel (không cần Streamlit).")
+    parser.add_argument("input_dir", help="Thư mục chứa các file .xlsx (hoặc các file .zip khi dùng --consolidate)")
+    parser.add_argument("-s", "--suffix", help="Hậu tố chứng từ (VD: A, B1, NV123); bắt buộc khi tạo file hạch toán")
+    parser.add_argument("-o", "--output", help="Đường dẫn file zip đầu ra (mặc định: <input_dir>/TongHop_<suffix>.zip)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Số tiến trình song song (1 = tuần tự)")
+    parser.add_argument("--profile", help="Ghi cProfile của lượt chạy ra file .prof (chạy tuần tự)")
+    parser.add_argument(
+        "--format", choices=OUTPUT_FORMATS, default="xlsx",
+        help="Định dạng file trong zip: xlsx (mỗi ngày 1 sheet) hoặc csv / parquet (mỗi ngày 1 file, ghi nhanh hơn để nhập MISA)",
+    )
+    parser.add_argument(
+        "--incremental", nargs="?", const=INCREMENTAL_STORE_PATH, metavar="STORE",
+        help=f"Chỉ xử lý lại các sheet ngày thay đổi so với lần chạy trước (kho mặc định: {INCREMENTAL_STORE_PATH})",
+    )
+    parser.add_argument(
+        "--archive", nargs="?", const=ARCHIVE_PATH, metavar="DIR",
+        help=f"Lưu thêm các dòng chứng từ vào kho Parquet để truy vấn nhiều tháng (kho mặc định: {ARCHIVE_PATH}, cần pyarrow)",
+    )
+    parser.add_argument(
+        "--consolidate", choices=["month", "quarter", "year", "all"],
+        help="Gộp các file .zip đầu ra trong thư mục như Tab 3, mỗi kỳ 1 file TongHop_<kỳ>.xlsx (-o là thư mục đầu ra)",
+    )
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        print(json.dumps({"event": "error", "error": f"Không tìm thấy thư mục: {args.input_dir}"}, ensure_ascii=False))
+        return 2
+    if args.consolidate:
+        return consolidate_folder(args.input_dir, args.output or args.input_dir, None if args.consolidate == "all" else args.consolidate)
+    if not args.suffix:
+        parser.error("cần --suffix khi tạo file hạch toán")
+    if (args.archive or args.format == "parquet") and pa is None:
+        parser.error("--archive / --format parquet cần cài pyarrow (pip install pyarrow)")
+    chu_hau_to = args.suffix.strip().upper()
+    names = sorted(n for n in os.listdir(args.input_dir) if n.lower().endswith(".xlsx") and not n.startswith("~$"))
+    if not names:
+        print(json.dumps({"event": "error", "error": f"Không có file .xlsx trong {args.input_dir}"}, ensure_ascii=False))
+        return 2
+
+    files = []
+    for name in names:
+        with open(os.path.join(args.input_dir, name), "rb") as f:
+            files.append((name, f.read()))
+
+    output_path = args.output or os.path.join(args.input_dir, f"TongHop_{chu_hau_to}.zip")
+    start = time.perf_counter()
+    sink = ZipSink()
+    metrics = Metrics()
+    if args.profile:
+        results, prof_bytes, _ = profile_call(
+            process_files, files, chu_hau_to, sink, max_workers=1, metrics=metrics, incremental_path=args.incremental,
+            archive_path=args.archive, output_format=args.format,
+        )
+        with open(args.profile, "wb") as out:
+            out.write(prof_bytes)
+    else:
+        results = process_files(
+            files, chu_hau_to, sink, max_workers=args.workers, metrics=metrics,
+            incremental_path=args.incremental, archive_path=args.archive, output_format=args.format,
+        )
+    with open(output_path, "wb") as out:
+        shutil.copyfileobj(sink.close(), out)  # chép dần từ file tạm, không đọc cả zip vào RAM
+    metrics_path = os.path.splitext(output_path)[0] + ".metrics.json"
+    with open(metrics_path, "w", encoding="utf-8") as out:
+        out.write(metrics.to_json())
+
+    failed = 0
+    for file_name, logs, error in results:
+        failed += bool(error)
+        print(json.dumps({
+            "event": "file", "file": file_name, "status": "error" if error else "ok",
+            "logs": logs, "error": error,
+        }, ensure_ascii=False))
+    print(json.dumps({
+        "event": "summary", "files": len(results), "failed": failed,
+        "output": output_path, "metrics": metrics_path, "seconds": round(time.perf_counter() - start, 3),
+    }, ensure_ascii=False))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())